@@ -2,11 +2,12 @@
 
 from bw2calc.errors import BW2CalcError
 
-from bw_superstructure.bwutils.multilca import MLCA, Contributions
+from bw_superstructure.bwutils.multilca import MLCA, Contributions, RetainError
 from bw_superstructure.superstructure.mlca import (
     SuperstructureContributions,
     SuperstructureMLCA,
 )
+from bw_superstructure.solvers import SolverError
 
 
 def do_LCA_calculations(data: dict):
@@ -28,13 +29,17 @@ def do_LCA_calculations(data: dict):
     elif calculation_type == "scenario":
         try:
             df = data.get("data")
-            mlca = SuperstructureMLCA(cs_name, df)  
+            mlca = SuperstructureMLCA(cs_name, df, **data.get("options", {}))
             contributions = SuperstructureContributions(mlca)  
         except AssertionError as e:
             # This occurs if the superstructure itself detects something is wrong.
             raise BW2CalcError("Scenario LCA failed.", str(e)).with_traceback(
                 e.__traceback__
             )
+        except (SolverError, RetainError) as e:
+            raise BW2CalcError("Scenario LCA failed.", str(e)).with_traceback(
+                e.__traceback__
+            )
         except ValueError as e:
             # This occurs if the LCA matrix does not contain any of the
             # exchanges mentioned in the superstructure data.
@@ -2,17 +2,26 @@
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from typing import Optional, Union, Iterable
 
 import brightway2 as bw
 from bw2analyzer import ContributionAnalysis
 
 from bw_superstructure.bwutils.commontasks import wrap_text
+from bw_superstructure.solvers import SparseSolver, get_solver
 from bw_superstructure.bwutils.metadata import AB_metadata
 
 
 ca = ContributionAnalysis()
 
+# Levels of results kept by `MLCA`, each level includes the previous ones.
+RETAIN_LEVELS = ("scores", "contributions", "full")
+
+
+class RetainError(ValueError):
+    """Raised for a `retain` level which is not one of `RETAIN_LEVELS`."""
+
 
 class MLCA(object):
     """Wrapper class for performing LCA calculations with many reference flows and impact categories.
@@ -34,6 +43,26 @@ class MLCA(object):
     ----------
     cs_name : str
         Name of the calculation setup
+    solver : str or `SparseSolver`, optional
+        Sparse solver used to factorize the technosphere matrix: a solver
+        instance, the name of a solver in `bw_superstructure.solvers.SOLVERS`
+        ("pardiso", "umfpack", "superlu" or the iterative "gmres" and
+        "bicgstab"), or "auto" to benchmark the available direct solvers on
+        the technosphere matrix and use the fastest one. Defaults to the
+        solver `bw2calc` would use. Pass e.g. ``GMRESSolver(tol=1e-10)`` to
+        set the tolerance of an iterative solver.
+    retain : str
+        Level of results that are calculated and kept, see `RETAIN_LEVELS`:
+        "scores" keeps only `lca_scores`, "contributions" adds the
+        elementary flow and process contributions and the scaling factors,
+        technosphere flows and inventory per reference flow, "full" (the
+        default) also keeps the `inventories` and `characterized_inventories`
+        matrices. Results that are not kept are None.
+    full_inventory : bool
+        If True (the default), the inventories hold all biosphere flows.
+        Otherwise they only hold the `characterized_rows`, which is all the
+        impact assessment needs. The impact assessment only uses these rows
+        in either case.
 
     Attributes
     ----------
@@ -58,8 +87,16 @@ class MLCA(object):
     lca: `bw2calc.lca.LCA`
         Brightway LCA instance used to perform LCA, LCI and LCIA
         calculations
+    solver: `SparseSolver`
+        Solver whose factorization of the technosphere matrix is set as
+        `lca.solver`
     method_matrices: list
         Contains the characterization matrix for each impact category.
+    characterization_factors: `numpy.ndarray`
+        2-dimensional array of shape (`methods`, `biosphere`) holding the
+        diagonals of `method_matrices`
+    characterized_rows: `numpy.ndarray`
+        Biosphere rows with a characterization factor in any of the methods
     lca_scores: `numpy.ndarray`
         2-dimensional array of shape (`func_units`, `methods`) holding the
         calculated LCA scores of each combination of reference flow and
@@ -101,18 +138,36 @@ class MLCA(object):
     ------
     ValueError
         If the given `cs_name` cannot be found in brightway calculation_setups
+    RetainError
+        If `retain` is not one of `RETAIN_LEVELS`
+    SolverError
+        If the `solver` is unknown or not installed
 
     """
 
     # Note: source: based on: activity-browser:
     # function from: Lib\site-packages\activity_browser\bwutils\multilca.py
     # branch: activity-browser-dev; version: 2022.11.16
+    # adaptations: selectable sparse solver for the technosphere matrix (`solver`)
+    # adaptations: results are only kept up to the `retain` level
+    # adaptations: the impact assessment only uses the `characterized_rows` of the inventory
 
-    def __init__(self, cs_name: str):
+    def __init__(
+        self,
+        cs_name: str,
+        solver: Union[str, SparseSolver, None] = None,
+        retain: str = "full",
+        full_inventory: bool = True,
+    ):
         try:
             cs = bw.calculation_setups[cs_name]
         except KeyError:
             raise ValueError("{} is not a known `calculation_setup`.".format(cs_name))
+        if retain not in RETAIN_LEVELS:
+            raise RetainError(
+                "retain must be one of {}, '{}' given.".format(RETAIN_LEVELS, retain)
+            )
+        self.retain = retain
         # reference flows and related indexes
         self.func_units = cs["inv"]
         self.fu_activity_keys = [list(fu.keys())[0] for fu in self.func_units]
@@ -126,11 +181,26 @@ class MLCA(object):
 
         # initial LCA and prepare method matrices
         self.lca = self._construct_lca()
-        self.lca.lci(factorize=True)
+        self.lca.load_lci_data()
+        self.lca.build_demand_array()
+        self.solver = get_solver(solver, self.lca.technosphere_matrix)
+        self._factorization = None
+        self.factorize_technosphere()
+        self.lca.lci_calculation()
         self.method_matrices = []
         for method in self.methods:
             self.lca.switch_method(method)
             self.method_matrices.append(self.lca.characterization_matrix)
+        # Diagonal characterization factors of all methods, stacked into a
+        # single (methods, biosphere) array.
+        self.characterization_factors = np.vstack(
+            [cf_matrix.diagonal() for cf_matrix in self.method_matrices]
+        )
+        self.characterized_rows = np.flatnonzero(
+            np.any(self.characterization_factors != 0, axis=0)
+        )
+        self.full_inventory = full_inventory
+        self._characterized_gather = None
 
         self.lca_scores = np.zeros((len(self.func_units), len(self.methods)))
 
@@ -142,32 +212,35 @@ class MLCA(object):
         ) = self.lca.reverse_dict()
 
         # Scaling
-        self.scaling_factors = dict()
+        self.scaling_factors = dict() if self.retains("contributions") else None
 
         # Technosphere product flows for a given reference flow
-        self.technosphere_flows = dict()
+        self.technosphere_flows = dict() if self.retains("contributions") else None
         # Life cycle inventory (biosphere flows) by reference flow
-        self.inventory = dict()
+        self.inventory = dict() if self.retains("contributions") else None
         # Inventory (biosphere flows) for specific reference flow (e.g. 2000x15000) and impact category.
-        self.inventories = dict()
+        self.inventories = dict() if self.retains("full") else None
         # Inventory multiplied by scaling (relative impact on environment) per impact category.
-        self.characterized_inventories = dict()
+        self.characterized_inventories = dict() if self.retains("full") else None
 
         # Summarized contributions for EF and processes.
-        self.elementary_flow_contributions = np.zeros(
-            (
-                len(self.func_units),
-                len(self.methods),
-                self.lca.biosphere_matrix.shape[0],
+        self.elementary_flow_contributions = None
+        self.process_contributions = None
+        if self.retains("contributions"):
+            self.elementary_flow_contributions = np.zeros(
+                (
+                    len(self.func_units),
+                    len(self.methods),
+                    self.lca.biosphere_matrix.shape[0],
+                )
             )
-        )
-        self.process_contributions = np.zeros(
-            (
-                len(self.func_units),
-                len(self.methods),
-                self.lca.technosphere_matrix.shape[0],
+            self.process_contributions = np.zeros(
+                (
+                    len(self.func_units),
+                    len(self.methods),
+                    self.lca.technosphere_matrix.shape[0],
+                )
             )
-        )
 
         self.func_unit_translation_dict = {
             str(bw.get_activity(list(func_unit.keys())[0])): func_unit
@@ -186,37 +259,138 @@ class MLCA(object):
     def _construct_lca(self):
         return bw.LCA(demand=self.func_units_dict, method=self.methods[0])
 
+    def retains(self, level: str) -> bool:
+        """Returns whether the results of the given `RETAIN_LEVELS` level are kept."""
+        return RETAIN_LEVELS.index(self.retain) >= RETAIN_LEVELS.index(level)
+
+    def factorize_technosphere(self) -> None:
+        """Factorize the current technosphere matrix with `self.solver`, unless
+        the LCA object still holds a factorization made by it.
+
+        The factorization is set as `lca.solver`, so that `redo_lci` uses it.
+        """
+        solver = getattr(self.lca, "solver", None)
+        if solver is None or solver is not self._factorization:
+            self._factorization = self.solver.factorize(self.lca.technosphere_matrix)
+            self.lca.solver = self._factorization
+
+    def characterized_biosphere_matrix(self) -> sparse.csr_matrix:
+        """Returns the current biosphere matrix with only the `characterized_rows`,
+        the other rows are empty.
+
+        The positions of these rows in the data array are found once per sparsity
+        pattern, after that only their values are copied.
+        """
+        matrix = sparse.csr_matrix(self.lca.biosphere_matrix)
+        if (
+            self._characterized_gather is None
+            or self._characterized_gather[0] is not matrix.indptr
+        ):
+            keep = np.zeros(matrix.shape[0], dtype=bool)
+            keep[self.characterized_rows] = True
+            counts = np.diff(matrix.indptr) * keep
+            indptr = np.concatenate([[0], np.cumsum(counts)]).astype(matrix.indptr.dtype)
+            gather = np.flatnonzero(np.repeat(keep, np.diff(matrix.indptr)))
+            self._characterized_gather = (matrix.indptr, indptr, gather)
+        _, indptr, gather = self._characterized_gather
+        return sparse.csr_matrix(
+            (matrix.data[gather], matrix.indices[gather], indptr), shape=matrix.shape
+        )
+
+    def characterize_biosphere(self) -> np.ndarray:
+        """Multiply the stacked characterization factors with the current
+        biosphere matrix.
+
+        Returns an array of shape (`methods`, `technosphere`) holding the
+        characterized biosphere flows per unit of each activity, so that
+        the process contributions of a supply array are a single
+        element-wise product.
+        """
+        biosphere = self.characterized_biosphere_matrix()
+        return (biosphere.T @ self.characterization_factors.T).T
+
+    def build_inventory(self) -> sparse.spmatrix:
+        """Builds `lca.inventory` from the current supply array, as in
+        `LCA.lci_calculation`, with all rows if `full_inventory` is set.
+
+        Returns the inventory of the `characterized_rows` for the impact assessment.
+        """
+        count = len(self.lca.activity_dict)
+        supply = sparse.spdiags([self.lca.supply_array], [0], count, count)
+        characterized = self.characterized_biosphere_matrix() * supply
+        if self.full_inventory:
+            self.lca.inventory = self.lca.biosphere_matrix * supply
+        else:
+            self.lca.inventory = characterized
+        return characterized
+
+    def characterize_inventory(
+        self, cf_matrix: sparse.spmatrix, inventory: sparse.spmatrix
+    ) -> None:
+        """Sets the characterized inventory of the given inventory on the LCA object,
+        as in `LCA.lcia_calculation`.
+        """
+        self.lca.characterization_matrix = cf_matrix
+        self.lca.characterized_inventory = cf_matrix * inventory
+
     def _perform_calculations(self):
         """Isolates the code which performs calculations to allow subclasses
         to either alter the code or redo calculations after matrix substitution.
+
+        Below the "full" `retain` level no inventory matrices are built, the
+        scores and contributions are calculated from the inventory vector with
+        the stacked `characterization_factors` instead.
         """
+        contributions, full = self.retains("contributions"), self.retains("full")
+        if contributions and not full:
+            characterized_biosphere = self.characterize_biosphere()
+        if full or (contributions and self.full_inventory):
+            biosphere = self.lca.biosphere_matrix
+        else:
+            # Only the characterized rows of the inventory are needed.
+            biosphere = self.characterized_biosphere_matrix()
         for row, func_unit in enumerate(self.func_units):
             # Do the LCA for the current reference flow
-            self.lca.redo_lci(func_unit)
+            self.lca.build_demand_array(func_unit)
+            self.lca.supply_array = self.lca.solve_linear_system()
+            if full:
+                characterized = self.build_inventory()
+                inventory = np.array(self.lca.inventory.sum(axis=1)).ravel()
+                self.inventories.update({str(func_unit): self.lca.inventory})
+            else:
+                inventory = biosphere @ self.lca.supply_array
 
             # Now update the:
             # - Scaling factors
             # - Technosphere flows
             # - Life cycle inventory
-            # - Life-cycle inventory (disaggregated by contributing process)
             # for current reference flow
-            self.scaling_factors.update({str(func_unit): self.lca.supply_array})
-            self.technosphere_flows.update(
-                {
-                    str(func_unit): np.multiply(
-                        self.lca.supply_array, self.lca.technosphere_matrix.diagonal()
+            if contributions:
+                self.scaling_factors.update({str(func_unit): self.lca.supply_array})
+                self.technosphere_flows.update(
+                    {
+                        str(func_unit): np.multiply(
+                            self.lca.supply_array,
+                            self.lca.technosphere_matrix.diagonal(),
+                        )
+                    }
+                )
+                self.inventory.update({str(func_unit): inventory})
+
+            if not full:
+                self.lca_scores[row] = self.characterization_factors @ inventory
+                if contributions:
+                    self.elementary_flow_contributions[row] = (
+                        self.characterization_factors * inventory
                     )
-                }
-            )
-            self.inventory.update(
-                {str(func_unit): np.array(self.lca.inventory.sum(axis=1)).ravel()}
-            )
-            self.inventories.update({str(func_unit): self.lca.inventory})
+                    self.process_contributions[row] = (
+                        characterized_biosphere * self.lca.supply_array
+                    )
+                continue
 
             # Now, for each method, take the current reference flow and do inventory analysis
             for col, cf_matrix in enumerate(self.method_matrices):
-                self.lca.characterization_matrix = cf_matrix
-                self.lca.lcia_calculation()
+                self.characterize_inventory(cf_matrix, characterized)
                 self.lca_scores[row, col] = self.lca.score
                 self.characterized_inventories[
                     row, col
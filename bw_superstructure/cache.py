@@ -0,0 +1,128 @@
+﻿import collections
+import os
+import pathlib as pt
+import pickle
+from typing import Any, Iterable, Optional, Union
+
+
+class ResultCache(object):
+    """Content-addressed disk cache for the results of single scenarios.
+
+    Each result is pickled to ``<key>.pkl`` in the cache directory, where the key is a
+    hash of all inputs of the scenario (see `SuperstructureMLCA.scenario_cache_key`),
+    so results can be shared between runs and versions of a scenario difference file.
+
+    Reading a result marks it as recently used. When the total size of the cache
+    exceeds `max_size`, the least recently used results are removed. The sizes of the
+    results are read once when the cache is opened and then tracked in memory.
+
+    Args:
+        directory (pt.Path or str): directory of the cache, created if needed
+        max_size (int, optional): maximum total size of the cache in bytes. Defaults to
+            None, which means the cache is not limited.
+    """
+
+    def __init__(self, directory: Union[pt.Path, str], max_size: Optional[int] = None):
+        self.directory = pt.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        # Sizes of the results by key, the least recently used first.
+        self._sizes = collections.OrderedDict()
+        stats = sorted(
+            ((path.stat(), path.stem) for path in self.directory.glob("*.pkl")),
+            key=lambda item: item[0].st_mtime,
+        )
+        for stat, key in stats:
+            self._sizes[key] = stat.st_size
+        self._size = sum(self._sizes.values())
+
+    def _track(self, key: str, size: Optional[int]) -> None:
+        """Marks the result of the key as most recently used with the given size, or
+        stops tracking it if the size is None."""
+        self._size -= self._sizes.pop(key, 0)
+        if size is not None:
+            self._sizes[key] = size
+            self._size += size
+
+    def _path(self, key: str) -> pt.Path:
+        return self.directory / "{}.pkl".format(key)
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def keys(self) -> list:
+        """Returns the keys of all cached results, the least recently used first."""
+        return list(self._sizes)
+
+    @property
+    def size(self) -> int:
+        """Total size of the cached results in bytes."""
+        return self._size
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached result for the key, or None if it is not cached.
+
+        Args:
+            key (str): hash of the inputs of the result
+
+        Returns:
+            the cached result, or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            self._track(key, None)
+            return None
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        # The modification time orders the results when the cache is opened again.
+        os.utime(path)
+        size = self._sizes.get(key)
+        self._track(key, path.stat().st_size if size is None else size)
+        return result
+
+    def put(self, key: str, result: Any) -> None:
+        """Stores a result in the cache and evicts old results if the cache is full.
+
+        Args:
+            key (str): hash of the inputs of the result
+            result: picklable result
+        """
+        path = self._path(key)
+        temporary = path.with_suffix(".tmp")
+        with open(temporary, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        temporary.replace(path)
+        self._track(key, path.stat().st_size)
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used results until the cache fits in `max_size`."""
+        if self.max_size is None:
+            return
+        while self._sizes and self._size > self.max_size:
+            key, size = self._sizes.popitem(last=False)
+            self._size -= size
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, keys: Optional[Iterable[str]] = None) -> None:
+        """Removes the results of the given keys from the cache.
+
+        Args:
+            keys (Iterable[str], optional): keys of the results to remove. Defaults to
+                None, which removes all results.
+        """
+        paths = (
+            list(self.directory.glob("*.pkl"))
+            if keys is None
+            else [self._path(key) for key in keys]
+        )
+        for path in paths:
+            self._track(path.stem, None)
+            if path.exists():
+                path.unlink()
@@ -17,6 +17,7 @@ from bw_superstructure.superstructure.mlca import (
     SuperstructureContributions,
 )
 from bw_superstructure.bwutils.calculations import do_LCA_calculations
+from bw_superstructure.solvers import SparseSolver
 
 
 def get_scenario_difference_dataframe(
@@ -37,7 +38,7 @@ def get_scenario_difference_dataframe(
 
 
 def calculate_lca_results(
-    calc_setup_name: str, scenario_diff_df: pd.DataFrame
+    calc_setup_name: str, scenario_diff_df: pd.DataFrame, **options
 ) -> Tuple[SuperstructureMLCA, SuperstructureContributions, None]:
 
     # imitating data-dict from AB
@@ -45,7 +46,9 @@ def calculate_lca_results(
             "cs_name": calc_setup_name,
             "calculation_type": "scenario",
             # AB also uses "simple" here for non-scenario LCA, see in do_LCA_calculations()
-            "data": scenario_diff_df
+            "data": scenario_diff_df,
+            # keyword arguments passed on to SuperstructureMLCA
+            "options": options,
             }
 
     print(f"Calculating LCA results for calculation setup: {calc_setup_name} .....")
@@ -61,6 +64,22 @@ def calculate_scenario_LCA(
     export_results_to_excel=True,
     fp_export_lca_results: Optional[pt.Path] = None,  #: pt.Path,
     fp_lcia_methods: Optional[pt.Path] = None,
+    batched: bool = False,
+    stacked: bool = False,
+    processes: int = 1,
+    solver: Union[str, SparseSolver, None] = None,
+    low_rank: bool = False,
+    retain: str = "full",
+    results_dir: Optional[pt.Path] = None,
+    result_dtype: str = "float64",
+    scenarios: Optional[list] = None,
+    run_dir: Optional[pt.Path] = None,
+    cache_dir: Optional[pt.Path] = None,
+    reorder: bool = False,
+    prune: bool = False,
+    reduce: bool = False,
+    full_inventory: bool = True,
+    screening: Optional[float] = None,
 ):
 
     if export_results_to_excel:
@@ -71,7 +90,26 @@ def calculate_scenario_LCA(
     scenario_diff_df = get_scenario_difference_dataframe(
         path_to_SDF, import_sheet=sdf_sheet
     )
-    mlca, contributions, mc = calculate_lca_results(calc_setup_name, scenario_diff_df)
+    mlca, contributions, mc = calculate_lca_results(
+        calc_setup_name,
+        scenario_diff_df,
+        batched=batched,
+        stacked=stacked,
+        processes=processes,
+        solver=solver,
+        low_rank=low_rank,
+        retain=retain,
+        results_dir=results_dir,
+        result_dtype=result_dtype,
+        scenarios=scenarios,
+        run_dir=run_dir,
+        cache=cache_dir,
+        reorder=reorder,
+        prune=prune,
+        reduce=reduce,
+        full_inventory=full_inventory,
+        screening=screening,
+    )
 
     if export_results_to_excel:
         export_lca_scores(mlca, fp_export_lca_results, fp_lcia_methods)
@@ -0,0 +1,652 @@
+﻿import inspect
+import time
+import warnings
+
+import numpy as np
+from scipy import sparse
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse.linalg import LinearOperator, bicgstab, gmres, spilu, splu, spsolve
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+
+try:
+    from pypardiso import PyPardisoSolver
+except ImportError:
+    PyPardisoSolver = None
+try:
+    import scikits.umfpack as umfpack
+except ImportError:
+    umfpack = None
+
+# scipy < 1.12 names the relative tolerance of the Krylov solvers `tol`.
+_TOLERANCE = "rtol" if "rtol" in inspect.signature(gmres).parameters else "tol"
+
+
+class SolverError(ValueError):
+    """Raised by `get_solver` for a solver which is unknown or not installed."""
+
+
+class SparseSolver(object):
+    """Base class for solvers of technosphere matrices which are refactorized many
+    times with the same sparsity pattern, e.g. once per scenario.
+
+    The fill-reducing ordering and symbolic analysis are computed by `analyze` for
+    the first matrix. `factorize` then only does the numeric factorization, as long
+    as the sparsity pattern of the matrix does not change. Otherwise the matrix is
+    analyzed again.
+
+    Attributes starting with an underscore hold the analysis and are not pickled, so
+    a solver can be passed to worker processes and analyzes again there.
+
+    The solve functions returned by `factorize` have an `nbytes` attribute with the
+    approximate memory held by the factorization and a `transposed` attribute, a
+    function which solves the transposed system with the same factorization. Solvers which are not `reusable`
+    can only solve with their most recent factorization, to keep several of their
+    factorizations use a copy of the solver for each.
+    """
+
+    name = None
+    iterative = False
+    reusable = True
+
+    def __init__(self):
+        self._indptr = None
+        self._indices = None
+
+    def __getstate__(self) -> dict:
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+        self.__dict__.update(state)
+
+    @staticmethod
+    def available() -> bool:
+        """Returns whether the library of this solver is installed."""
+        return True
+
+    def is_analyzed(self, matrix: sparse.csr_matrix) -> bool:
+        """Returns whether the sparsity pattern of the matrix was already analyzed."""
+        return (
+            self._indptr is not None
+            and np.array_equal(self._indptr, matrix.indptr)
+            and np.array_equal(self._indices, matrix.indices)
+        )
+
+    def analyze(self, matrix: sparse.csr_matrix) -> None:
+        """Computes the ordering and symbolic analysis for the sparsity pattern of the matrix.
+
+        Args:
+            matrix (sparse.csr_matrix): square matrix in canonical CSR format
+        """
+        self._indptr = matrix.indptr.copy()
+        self._indices = matrix.indices.copy()
+
+    def factorize(self, matrix: sparse.spmatrix) -> Callable:
+        """Numerically factorizes the matrix, reusing the analysis of its sparsity pattern.
+
+        Args:
+            matrix (sparse.spmatrix): square matrix
+
+        Returns:
+            Callable: function which solves the factorized system for a right-hand side
+            array of shape (n,) or (n, k), its `transposed` attribute solves the
+            transposed system
+        """
+        matrix = sparse.csr_matrix(matrix)
+        if not matrix.has_canonical_format:
+            matrix = matrix.copy()
+            matrix.sum_duplicates()
+        if not self.is_analyzed(matrix):
+            self.analyze(matrix)
+        return self._factorize(matrix)
+
+    def _factorize(self, matrix: sparse.csr_matrix) -> Callable:
+        raise NotImplementedError
+
+    def release(self) -> None:
+        """Frees the memory held outside of Python by the factorizations of this solver."""
+
+    @staticmethod
+    def _nbytes(matrix: sparse.spmatrix) -> int:
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+    @staticmethod
+    def _csc_gather(matrix: sparse.csr_matrix) -> Tuple[sparse.csc_matrix, np.ndarray]:
+        """Builds a CSC matrix with the sparsity pattern of the given CSR matrix and
+        the positions in the CSR data array of each CSC entry, so that the data of
+        later matrices with the same pattern can be copied over without a format
+        conversion.
+        """
+        positions = sparse.csr_matrix(
+            (np.arange(1, matrix.nnz + 1, dtype=float), matrix.indices, matrix.indptr),
+            shape=matrix.shape,
+        ).tocsc()
+        positions.sort_indices()
+        gather = positions.data.astype(np.int64) - 1
+        return positions, gather
+
+
+class SuperLUSolver(SparseSolver):
+    """Solver based on `scipy.sparse.linalg.splu`.
+
+    SuperLU has no separate symbolic phase, so each matrix is ordered and factorized
+    from scratch. The analysis only keeps the conversion to CSC format.
+    """
+
+    name = "superlu"
+
+    def __init__(self):
+        super().__init__()
+        self._csc = None
+        self._gather = None
+
+    def analyze(self, matrix: sparse.csr_matrix) -> None:
+        super().analyze(matrix)
+        self._csc, self._gather = self._csc_gather(matrix)
+
+    def _factorize(self, matrix: sparse.csr_matrix) -> Callable:
+        self._csc.data[:] = matrix.data[self._gather]
+        lu = splu(self._csc)
+
+        def solve(b: np.ndarray) -> np.ndarray:
+            return lu.solve(np.asarray(b, dtype=float))
+
+        solve.transposed = lambda b: lu.solve(np.asarray(b, dtype=float), trans="T")
+        solve.nbytes = (lu.L.nnz + lu.U.nnz) * (
+            self._csc.data.itemsize + self._csc.indices.itemsize
+        )
+        return solve
+
+
+class UmfpackSolver(SparseSolver):
+    """Solver based on UMFPACK from `scikit-umfpack`.
+
+    The symbolic factorization of the first matrix is kept in the UMFPACK context
+    and reused by the numeric factorization of all following matrices.
+
+    Only the most recent factorization can be used to solve.
+    """
+
+    name = "umfpack"
+    reusable = False
+
+    def __init__(self):
+        super().__init__()
+        self._context = None
+        self._csc = None
+        self._gather = None
+
+    @staticmethod
+    def available() -> bool:
+        return umfpack is not None
+
+    def analyze(self, matrix: sparse.csr_matrix) -> None:
+        self.release()
+        super().analyze(matrix)
+        self._csc, self._gather = self._csc_gather(matrix)
+        family = "dl" if self._csc.indices.dtype == np.int64 else "di"
+        self._context = umfpack.UmfpackContext(family)
+        self._context.symbolic(self._csc)
+
+    def _factorize(self, matrix: sparse.csr_matrix) -> Callable:
+        self._csc.data[:] = matrix.data[self._gather]
+        csc = self._csc.copy()
+        context = self._context
+        context.numeric(csc)
+
+        def solve_system(system: int, b: np.ndarray) -> np.ndarray:
+            if b.ndim == 1:
+                return context.solve(system, csc, b, autoTranspose=False)
+            return np.column_stack(
+                [
+                    context.solve(system, csc, column, autoTranspose=False)
+                    for column in b.T
+                ]
+            )
+
+        def solve(b: np.ndarray) -> np.ndarray:
+            return solve_system(umfpack.UMFPACK_A, b)
+
+        solve.transposed = lambda b: solve_system(umfpack.UMFPACK_At, b)
+
+        # UMFPACK reports the size of the numeric factorization in 8 byte units.
+        solve.nbytes = self._nbytes(csc) + int(
+            8 * context.info[umfpack.UMFPACK_NUMERIC_SIZE]
+        )
+        return solve
+
+    def release(self) -> None:
+        if self._context is not None:
+            self._context.free()
+            self._context = None
+            # The sparsity pattern has to be analyzed again.
+            self._indptr = None
+
+
+class PardisoSolver(SparseSolver):
+    """Solver based on the Intel MKL PARDISO solver from `pypardiso`.
+
+    The analysis phase (11) is done once, each factorization only runs the numeric
+    phase (22). Only the most recent factorization can be used to solve.
+    """
+
+    name = "pardiso"
+    reusable = False
+
+    def __init__(self):
+        super().__init__()
+        self._pardiso = None
+
+    @staticmethod
+    def available() -> bool:
+        return PyPardisoSolver is not None
+
+    def _call(self, phase: int, matrix: sparse.csr_matrix, b: np.ndarray) -> np.ndarray:
+        self._pardiso.set_phase(phase)
+        return self._pardiso._call_pardiso(matrix, b)
+
+    def analyze(self, matrix: sparse.csr_matrix) -> None:
+        self.release()
+        super().analyze(matrix)
+        self._pardiso = PyPardisoSolver()
+        self._pardiso._check_A(matrix)
+        self._call(11, matrix, np.zeros((matrix.shape[0], 1)))
+
+    def _factorize(self, matrix: sparse.csr_matrix) -> Callable:
+        # PARDISO needs the matrix again when solving, keep the current values.
+        matrix = matrix.copy()
+        self._pardiso._check_A(matrix)
+        self._call(22, matrix, np.zeros((matrix.shape[0], 1)))
+
+        def solve(b: np.ndarray, transposed: bool = False) -> np.ndarray:
+            # iparm(12) = 2 solves the transposed system.
+            self._pardiso.iparm[11] = 2 if transposed else 0
+            try:
+                x = self._call(33, matrix, self._pardiso._check_b(matrix, b))
+            finally:
+                self._pardiso.iparm[11] = 0
+            return x.reshape(b.shape)
+
+        solve.transposed = lambda b: solve(b, transposed=True)
+
+        # iparm(16) and iparm(17) hold the permanent memory of the analysis and the
+        # memory of the numeric factorization in KB.
+        solve.nbytes = self._nbytes(matrix) + 1024 * int(
+            self._pardiso.iparm[15] + self._pardiso.iparm[16]
+        )
+        return solve
+
+    def release(self) -> None:
+        if self._pardiso is not None:
+            self._pardiso.free_memory(everything=True)
+            self._pardiso = None
+            # The sparsity pattern has to be analyzed again.
+            self._indptr = None
+
+
+class IterativeSolver(SparseSolver):
+    """Base class for Krylov solvers for very large technosphere matrices, which are
+    not factorized at all.
+
+    The incomplete LU factorization of the first (baseline) matrix is used as
+    preconditioner for all following matrices with the same sparsity pattern. Each
+    column of the right-hand side is warm-started from the latest solution for the
+    same column and direction (forward or transposed), so that similar consecutive
+    scenarios with the same right-hand sides converge in a few iterations. The
+    columns are identified by their position, or by the `columns` keyword of the
+    solve functions, e.g. the reference flow of each demand. If a solve does not
+    converge, it falls back to a direct solve with a warning.
+
+    Args:
+        tol (float): relative tolerance of the residual
+        maxiter (int, optional): maximum number of iterations per solve
+        drop_tol (float): drop tolerance of the incomplete LU factorization
+        fill_factor (float): fill factor of the incomplete LU factorization
+    """
+
+    iterative = True
+
+    def __init__(
+        self,
+        tol: float = 1e-8,
+        maxiter: Optional[int] = None,
+        drop_tol: float = 1e-4,
+        fill_factor: float = 10,
+    ):
+        super().__init__()
+        self.tol = tol
+        self.maxiter = maxiter
+        self.drop_tol = drop_tol
+        self.fill_factor = fill_factor
+        self._preconditioner = None
+        self._transposed_preconditioner = None
+        self._previous = {}
+
+    @staticmethod
+    def _method(*args, **kwargs) -> Tuple[np.ndarray, int]:
+        raise NotImplementedError
+
+    def analyze(self, matrix: sparse.csr_matrix) -> None:
+        super().analyze(matrix)
+        ilu = spilu(
+            matrix.tocsc(), drop_tol=self.drop_tol, fill_factor=self.fill_factor
+        )
+        self._preconditioner = LinearOperator(matrix.shape, ilu.solve)
+        self._transposed_preconditioner = LinearOperator(
+            matrix.shape, lambda b: ilu.solve(b, trans="T")
+        )
+        self._previous = {}
+
+    def _iterate(
+        self,
+        matrix: sparse.spmatrix,
+        b: np.ndarray,
+        x0: Optional[np.ndarray],
+        transposed: bool = False,
+    ) -> Tuple[np.ndarray, int]:
+        preconditioner = (
+            self._transposed_preconditioner if transposed else self._preconditioner
+        )
+        options = {_TOLERANCE: self.tol, "maxiter": self.maxiter, "M": preconditioner}
+        return self._method(matrix, b, x0=x0, **options)
+
+    def _factorize(self, matrix: sparse.csr_matrix) -> Callable:
+        # The scenario values are written into the matrix later on, keep these.
+        matrix = matrix.copy()
+
+        def solve_vector(b: np.ndarray, transposed: bool, column) -> np.ndarray:
+            key = (transposed, column)
+            system = matrix.T if transposed else matrix
+            x, info = self._iterate(system, b, self._previous.get(key), transposed)
+            if info != 0:
+                warnings.warn(
+                    "{} did not converge (info={}), solving directly.".format(
+                        self.name, info
+                    )
+                )
+                x = spsolve(system.tocsc(), b)
+            self._previous[key] = x
+            return x
+
+        def solve(
+            b: np.ndarray, transposed: bool = False, columns: Optional[list] = None
+        ) -> np.ndarray:
+            if columns is None:
+                columns = range(1 if b.ndim == 1 else b.shape[1])
+            if b.ndim == 1:
+                return solve_vector(b, transposed, columns[0])
+            return np.column_stack(
+                [
+                    solve_vector(vector, transposed, column)
+                    for vector, column in zip(b.T, columns)
+                ]
+            )
+
+        solve.transposed = lambda b: solve(b, transposed=True)
+        solve.nbytes = self._nbytes(matrix)
+        return solve
+
+
+class GMRESSolver(IterativeSolver):
+    """Iterative solver based on `scipy.sparse.linalg.gmres`, see `IterativeSolver`."""
+
+    name = "gmres"
+    _method = staticmethod(gmres)
+
+
+class BiCGSTABSolver(IterativeSolver):
+    """Iterative solver based on `scipy.sparse.linalg.bicgstab`, see `IterativeSolver`."""
+
+    name = "bicgstab"
+    _method = staticmethod(bicgstab)
+
+
+class ReducedSolver(SparseSolver):
+    """Wraps a solver to solve only the sub-system of the given rows and columns, for
+    matrices whose solutions are zero outside of these columns, e.g. the supply
+    chains of the reference flows of a calculation setup.
+
+    The rows must contain all non-zero entries of the columns, and the right-hand
+    sides must be zero outside of the rows. The solutions are mapped back to the full
+    index. The transposed system is only solved for the rows, the other entries of
+    its solutions are zero, not the solution of the full transposed system. Keyword
+    arguments of the solve function are passed on to the solver of the sub-matrix.
+
+    Args:
+        solver (SparseSolver): solver for the sub-matrix
+        rows (np.ndarray): indices of the rows of the sub-matrix
+        cols (np.ndarray): indices of the columns of the sub-matrix
+    """
+
+    def __init__(
+        self,
+        solver: Optional[SparseSolver] = None,
+        rows: Optional[np.ndarray] = None,
+        cols: Optional[np.ndarray] = None,
+    ):
+        super().__init__()
+        self.solver = solver
+        self.rows = rows
+        self.cols = cols
+        self._submatrix = None
+        self._gather = None
+
+    @property
+    def name(self) -> str:
+        return self.solver.name
+
+    @property
+    def iterative(self) -> bool:
+        return self.solver.iterative
+
+    @property
+    def reusable(self) -> bool:
+        return self.solver.reusable
+
+    def analyze(self, matrix: sparse.csr_matrix) -> None:
+        super().analyze(matrix)
+        positions = sparse.csr_matrix(
+            (np.arange(1, matrix.nnz + 1, dtype=float), matrix.indices, matrix.indptr),
+            shape=matrix.shape,
+        )[self.rows][:, self.cols]
+        positions.sort_indices()
+        self._gather = positions.data.astype(np.int64) - 1
+        self._submatrix = positions
+
+    def _factorize(self, matrix: sparse.csr_matrix) -> Callable:
+        submatrix = sparse.csr_matrix(
+            (
+                matrix.data[self._gather],
+                self._submatrix.indices,
+                self._submatrix.indptr,
+            ),
+            shape=self._submatrix.shape,
+        )
+        solve_reduced = self.solver.factorize(submatrix)
+        size, rows, cols = matrix.shape[0], self.rows, self.cols
+
+        def solve(b: np.ndarray, **options) -> np.ndarray:
+            x = np.zeros((size,) + b.shape[1:])
+            x[cols] = solve_reduced(b[rows], **options)
+            return x
+
+        def solve_transposed(b: np.ndarray) -> np.ndarray:
+            x = np.zeros((size,) + b.shape[1:])
+            x[rows] = solve_reduced.transposed(b[cols])
+            return x
+
+        solve.transposed = solve_transposed
+        solve.nbytes = getattr(solve_reduced, "nbytes", 0)
+        return solve
+
+    def release(self) -> None:
+        self.solver.release()
+
+
+def low_rank_update(
+    solve: Callable, columns: np.ndarray, delta: np.ndarray
+) -> Callable:
+    """Returns a solve function for a factorized matrix of which some columns changed,
+    using the Sherman-Morrison-Woodbury identity instead of a new factorization.
+
+    With the changed matrix A = A0 + D E^T, where D holds the changes of the k
+    changed columns and E the corresponding unit vectors:
+
+        A^-1 b = y - Z (I + E^T Z)^-1 E^T y,  with y = A0^-1 b and Z = A0^-1 D
+
+    Computing Z costs k solves with the factorization of A0, so this is cheaper than a
+    new factorization of A as long as k is small. The transposed system is solved the
+    same way with A^T = A0^T + E D^T, its k solves are done on first use.
+
+    Args:
+        solve (Callable): solve function of the factorization of A0
+        columns (np.ndarray): indices of the k changed columns
+        delta (np.ndarray): array of shape (n, k) with the change of these columns
+
+    Returns:
+        Callable: function which solves the changed system for a right-hand side
+        array of shape (n,) or (n, k), further keyword arguments are passed on to
+        `solve`
+    """
+    if len(columns) == 0:
+        return solve
+    z = solve(delta).reshape(delta.shape)
+    capacitance = lu_factor(np.eye(len(columns)) + z[columns])
+
+    def solve_updated(b: np.ndarray, **options) -> np.ndarray:
+        y = solve(b, **options)
+        return y - z @ lu_solve(capacitance, y[columns])
+
+    transposed_z = []
+
+    def solve_updated_transposed(b: np.ndarray) -> np.ndarray:
+        if not transposed_z:
+            unit = np.zeros(delta.shape)
+            unit[columns, np.arange(len(columns))] = 1
+            transposed_z.append(solve.transposed(unit).reshape(delta.shape))
+        # The capacitance matrix of the transposed system is I + (E^T Z)^T.
+        y = solve.transposed(b)
+        return y - transposed_z[0] @ lu_solve(capacitance, delta.T @ y, trans=1)
+
+    solve_updated.transposed = solve_updated_transposed
+    # The factorization of A0 is shared and not counted.
+    solve_updated.nbytes = z.nbytes + capacitance[0].nbytes
+    return solve_updated
+
+
+SOLVERS = {
+    solver.name: solver
+    for solver in (
+        PardisoSolver,
+        UmfpackSolver,
+        SuperLUSolver,
+        GMRESSolver,
+        BiCGSTABSolver,
+    )
+}
+
+
+def available_solvers(iterative: bool = True) -> list:
+    """Returns the names of the solvers whose library is installed, the direct
+    solvers in the order of preference of `bw2calc` first.
+
+    Args:
+        iterative (bool): whether to include the iterative solvers
+    """
+    return [
+        name
+        for name, solver in SOLVERS.items()
+        if solver.available() and (iterative or not solver.iterative)
+    ]
+
+
+def default_solver() -> SparseSolver:
+    """Returns a solver for the same library that `bw2calc` uses by default:
+    PARDISO if `pypardiso` is installed, otherwise UMFPACK if `scikit-umfpack` is
+    installed, otherwise SuperLU.
+    """
+    return SOLVERS[available_solvers()[0]]()
+
+
+def benchmark_solvers(
+    matrix: sparse.spmatrix,
+    solvers: Optional[Iterable[str]] = None,
+    rhs: Optional[np.ndarray] = None,
+    repeat: int = 3,
+) -> Dict[str, float]:
+    """Times the numeric factorization and one solve of the matrix with each solver.
+
+    The analysis of the sparsity pattern is done once per solver before timing, as
+    it is reused for all scenarios.
+
+    Args:
+        matrix (sparse.spmatrix): square matrix, e.g. a technosphere matrix
+        solvers (Iterable[str], optional): names of the solvers to compare. Defaults
+            to all available direct solvers, as repeated solves of the same system
+            would favour the warm-started iterative solvers.
+        rhs (np.ndarray, optional): right-hand side of shape (n,) or (n, k) to solve
+            for. Defaults to a vector of ones.
+        repeat (int): number of timed runs per solver, the fastest one is reported
+
+    Returns:
+        Dict[str, float]: seconds per factorization and solve by solver name,
+        fastest first
+    """
+    rhs = np.ones(matrix.shape[0]) if rhs is None else rhs
+    timings = {}
+    for name in available_solvers(iterative=False) if solvers is None else solvers:
+        solver = get_solver(name)
+        try:
+            solver.factorize(matrix)
+            best = np.inf
+            for _ in range(max(1, repeat)):
+                start = time.perf_counter()
+                solver.factorize(matrix)(rhs)
+                best = min(best, time.perf_counter() - start)
+        finally:
+            solver.release()
+        timings[name] = best
+    return dict(sorted(timings.items(), key=lambda item: item[1]))
+
+
+def get_solver(
+    solver: Union[str, SparseSolver, None] = None,
+    matrix: Optional[sparse.spmatrix] = None,
+) -> SparseSolver:
+    """Returns a solver instance for the given choice.
+
+    Args:
+        solver (str | SparseSolver, optional): a solver instance, the name of a solver
+            (see `SOLVERS`), "auto" to pick the fastest available solver for `matrix`
+            with `benchmark_solvers`, or None for `default_solver`
+        matrix (sparse.spmatrix, optional): matrix to benchmark with, required for
+            "auto"
+
+    Returns:
+        SparseSolver: the selected solver
+
+    Raises:
+        SolverError: if the solver is unknown or its library is not installed, or
+            "auto" is given without a matrix
+    """
+    if solver is None:
+        return default_solver()
+    if isinstance(solver, SparseSolver):
+        return solver
+    if solver == "auto":
+        if matrix is None:
+            raise SolverError("A matrix is needed to select the solver automatically.")
+        return get_solver(next(iter(benchmark_solvers(matrix))))
+    if solver not in SOLVERS:
+        raise SolverError(
+            "Unknown solver '{}', choose one of: {}, or 'auto'.".format(
+                solver, ", ".join(SOLVERS)
+            )
+        )
+    if not SOLVERS[solver].available():
+        raise SolverError(
+            "The library for solver '{}' is not installed, available are: {}.".format(
+                solver, ", ".join(available_solvers())
+            )
+        )
+    return SOLVERS[solver]()
@@ -0,0 +1,118 @@
+import pathlib as pt
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial.distance import cdist
+
+
+def csr_data_slots(
+    matrix: sparse.spmatrix, rows: np.ndarray, cols: np.ndarray
+) -> Tuple[sparse.csr_matrix, np.ndarray]:
+    """Find the positions of the given (row, col) entries in the data array
+    of a CSR matrix.
+
+    Entries missing from the sparsity pattern are inserted as explicit
+    zeros first. Returns the (possibly extended) matrix in canonical CSR
+    format and the positions, so that values can be written with
+    ``matrix.data[slots] = values``.
+    """
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sum_duplicates()
+    n_cols = matrix.shape[1]
+    entry_rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    existing = entry_rows.astype(np.int64) * n_cols + matrix.indices
+    wanted = rows.astype(np.int64) * n_cols + cols
+    missing = np.setdiff1d(wanted, existing)
+    if len(missing):
+        coo = matrix.tocoo()
+        matrix = sparse.csr_matrix(
+            (
+                np.concatenate([coo.data, np.zeros(len(missing))]),
+                (
+                    np.concatenate([coo.row, missing // n_cols]),
+                    np.concatenate([coo.col, missing % n_cols]),
+                ),
+            ),
+            shape=matrix.shape,
+        )
+        matrix.sum_duplicates()
+        entry_rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        existing = entry_rows.astype(np.int64) * n_cols + matrix.indices
+    # Canonical CSR data is ordered by row, then column.
+    return matrix, np.searchsorted(existing, wanted)
+
+
+def merge_scenario_values(
+    values: np.ndarray, slots: np.ndarray, current: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge the scenario values of exchanges which are written to the same
+    data slot of a matrix and fill in their NaN values.
+
+    Of exchanges with the same slot, the last non-NaN value wins. A NaN keeps
+    the value of the previous scenario, or the `current` value of the matrix
+    for the first scenario.
+
+    Returns the unique slots, the index of the first exchange of each slot and
+    the values as an array of shape (scenarios, unique slots).
+    """
+    unique_slots, first, inverse = np.unique(
+        slots, return_index=True, return_inverse=True
+    )
+    merged = np.full((values.shape[0], len(unique_slots)), np.nan)
+    scenario, exchange = np.nonzero(~np.isnan(values))
+    merged[scenario, inverse.ravel()[exchange]] = values[scenario, exchange]
+    merged = pd.DataFrame(merged).ffill().to_numpy()
+    merged = np.where(np.isnan(merged), current[unique_slots], merged)
+    return unique_slots, first, merged
+
+
+def duplicate_scenarios(values: np.ndarray) -> np.ndarray:
+    """Return for each row of `values`, the matrix values applied by one
+    scenario, the index of the first row with exactly the same values.
+    """
+    _, first, inverse = np.unique(
+        values, axis=0, return_index=True, return_inverse=True
+    )
+    return first[inverse.ravel()]
+
+
+def greedy_scenario_order(values: np.ndarray) -> List[int]:
+    """Return an order of the rows of `values`, the matrix values applied by
+    one scenario each, along a short path through the scenario space.
+
+    Starting from the first row, the path greedily continues with the nearest
+    remaining row by the L1 distance.
+    """
+    if len(values) < 3:
+        return list(range(len(values)))
+    distances = cdist(values, values, metric="cityblock")
+    visited = np.zeros(len(values), dtype=bool)
+    order = [0]
+    visited[0] = True
+    for _ in range(len(values) - 1):
+        nearest = int(np.argmin(np.where(visited, np.inf, distances[order[-1]])))
+        order.append(nearest)
+        visited[nearest] = True
+    return order
+
+
+def result_array(
+    shape: tuple,
+    dtype: Union[str, np.dtype] = np.float64,
+    directory: Optional[pt.Path] = None,
+    name: Optional[str] = None,
+) -> np.ndarray:
+    """Allocate a zero-filled result array, in memory or, if a directory is
+    given, as a memory-mapped ``<name>.npy`` file in that directory.
+
+    The file can be opened again with ``np.load(path, mmap_mode="r")``.
+    """
+    if directory is None:
+        return np.zeros(shape, dtype=dtype)
+    directory = pt.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    return np.lib.format.open_memmap(
+        directory / "{}.npy".format(name), mode="w+", dtype=dtype, shape=shape
+    )
@@ -1,14 +1,34 @@
 ﻿# Note: source: activity-browser, objects from: Lib\site-packages\activity_browser\bwutils\superstructure\mlca.py
 
+import collections
+import copy
+import hashlib
+import itertools
+import json
+import multiprocessing
+import pathlib as pt
+import pickle
+import time
 import pandas as pd
 import numpy as np
-from typing import Iterable, Optional, List, Tuple, Union
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional, List, Tuple, Union
+from scipy import sparse
+from scipy.sparse import csgraph
 
 from bw2calc.matrices import TechnosphereBiosphereMatrixBuilder as MB
 
+from bw_superstructure.cache import ResultCache
+from bw_superstructure.solvers import ReducedSolver, SparseSolver, low_rank_update
 from bw_superstructure.bwutils.utils import Index
 from bw_superstructure.bwutils.multilca import MLCA, Contributions
 from bw_superstructure.bwutils.commontasks import format_activity_label
+from bw_superstructure.superstructure.arrays import (
+    csr_data_slots,
+    duplicate_scenarios,
+    greedy_scenario_order,
+    merge_scenario_values,
+    result_array,
+)
 from bw_superstructure.superstructure.dataframe import (
     scenario_names_from_df,
     arrays_from_indexed_superstructure,
@@ -16,9 +36,177 @@ from bw_superstructure.superstructure.dataframe import (
 )
 
 
+class ScenarioResult(NamedTuple):
+    """Results of all reference flows and impact categories for a single
+    scenario, as calculated by `SuperstructureMLCA.calculate_scenario`.
+
+    The arrays have the same layout as the corresponding attributes of
+    `SuperstructureMLCA` without the scenario dimension, the dictionaries
+    are keyed by the reference flow index (and method index). Results above
+    the `retain` level of the calculation are None, as are the `intensities`
+    unless the calculation is `adjoint`.
+    """
+
+    index: int
+    name: str
+    lca_scores: np.ndarray
+    elementary_flow_contributions: np.ndarray
+    process_contributions: np.ndarray
+    scaling_factors: dict
+    technosphere_flows: dict
+    inventory: dict
+    inventories: dict
+    characterized_inventories: dict
+    intensities: Optional[np.ndarray] = None
+    solves_skipped: int = 0
+
+
+class MatrixUpdate(NamedTuple):
+    """Precompiled scenario values of the superstructure exchanges that are
+    written into one LCA matrix, see `SuperstructureMLCA.compile_update_plan`.
+
+    `slots` are the distinct positions of the exchanges in the data array of
+    the CSR matrix, `values` has the shape (scenarios, slots) and `baseline`
+    holds the values of the original matrix.
+    """
+
+    matrix: str
+    rows: np.ndarray
+    cols: np.ndarray
+    slots: np.ndarray
+    values: np.ndarray
+    baseline: np.ndarray
+
+
+class ScreeningResult(NamedTuple):
+    """Approximate scores of all scenarios, as estimated by
+    `SuperstructureMLCA.screen_scenarios`.
+
+    `lca_scores` and `errors` have the layout of `SuperstructureMLCA.lca_scores`,
+    `flagged` holds the indices of the scenarios whose error indicator exceeds
+    the threshold.
+    """
+
+    lca_scores: np.ndarray
+    errors: np.ndarray
+    flagged: List[int]
+
+
+# Copy of the SuperstructureMLCA owned by a worker process, see `iter_scenarios`.
+_worker_mlca = None
+
+
+def _initialize_worker(mlca: "SuperstructureMLCA") -> None:
+    global _worker_mlca
+    _worker_mlca = mlca
+
+
+def _calculate_scenario_worker(ps_col: int) -> ScenarioResult:
+    """Calculate a single scenario in a worker process."""
+    _worker_mlca.set_scenario(ps_col)
+    return _worker_mlca.calculate_scenario(ps_col)
+
+
 class SuperstructureMLCA(MLCA):
     """Subclass of the `MLCA` class which adds another dimension in the form
     of scenarios.
+
+    Parameters
+    ----------
+    cs_name : str
+        Name of the calculation setup
+    df : `pandas.DataFrame`
+        Scenario difference data, indexed by (input, output, flow type) with
+        one column per scenario
+    batched : bool
+        If True, the technosphere matrix of each scenario is factorized once
+        and all reference flows are solved together in a single
+        multi-right-hand-side solve, instead of one `redo_lci` per reference
+        flow. Iterative solvers always solve batched, so that each reference
+        flow is warm-started from its own solution of the previous scenario.
+    stacked : bool
+        If True, the scores and contributions of all impact categories are
+        calculated together from the stacked `characterization_factors`
+        instead of building one characterized inventory per impact category.
+        `characterized_inventories` is not filled in this mode.
+    processes : int
+        Number of worker processes over which the scenarios are distributed.
+        Each worker owns a copy of the LCA object; the results are collected
+        in the original scenario order.
+    solver : str or `SparseSolver`, optional
+        Sparse solver for the technosphere matrix, see `MLCA`. The sparsity
+        pattern is the same for all scenarios, so the solver only analyzes it
+        once and then does numeric factorizations.
+    low_rank : bool
+        If True, the baseline technosphere matrix is factorized once and each
+        scenario is solved as a low-rank update of its changed columns with
+        the Sherman-Morrison-Woodbury identity. Scenarios which change more
+        than `max_rank` columns are factorized as usual.
+    max_rank : int, optional
+        Largest number of changed columns solved as a low-rank update.
+        Defaults to the number of solves that take as long as one
+        factorization, measured on the baseline technosphere matrix.
+    retain : str
+        Level of results that are calculated and kept, see `MLCA`. Below
+        "full", the characterized inventories are never built and the
+        scores and contributions are calculated as in `stacked` mode.
+    results_dir : str or `pathlib.Path`, optional
+        If given, `lca_scores`, `elementary_flow_contributions` and
+        `process_contributions` are memory-mapped ``.npy`` files in this
+        directory instead of arrays in memory, so that results larger than
+        the available memory are written to disk.
+    result_dtype : str or `numpy.dtype`
+        Data type of these arrays, e.g. "float32" to halve their size.
+    scenarios : list, optional
+        Names or column indices of the scenarios in `df` to calculate,
+        defaults to all. Only these scenarios are part of the results.
+    run_dir : str or `pathlib.Path`, optional
+        If given, the result of each scenario is saved to this directory as
+        soon as it is calculated, together with a fingerprint of the
+        scenario data, calculation setup, characterization factors, `retain`
+        level, solver, the modes which change the results (`stacked`,
+        `full_inventory`, `adjoint`, `reduce`) and LCA matrices.
+        `calculate` then loads the saved scenarios of a previous run with the
+        same fingerprint and only calculates the missing ones.
+    cache : `ResultCache`, str or `pathlib.Path`, optional
+        Result cache, or the directory of one, shared between runs. A
+        scenario whose inputs (see `scenario_cache_key`) are already in the
+        cache is loaded from it instead of being calculated.
+    reorder : bool
+        If True, the scenarios are calculated along a short path through the
+        scenario space (see `order_scenarios`) instead of in the order of
+        `df`, which speeds up warm-started iterative solvers. The results
+        keep the original order.
+    factorization_memory : int
+        Memory budget in bytes for the technosphere factorizations of
+        recently visited scenarios kept by `update_lca_calculation_for_sankey`,
+        so that returning to a scenario only needs back-substitutions. The
+        least recently used factorizations are dropped first, 0 disables it.
+    adjoint : bool
+        If True, the transposed technosphere system is also solved for each
+        scenario and impact category, giving the `intensities`: the score per
+        unit of demand of every product. The score of any demand is then a
+        dot product, see `score_demand` and `activity_intensities`.
+    prune : bool
+        If True, the results of a reference flow are copied from the
+        previously calculated scenario instead of being solved again when the
+        scenario only changes exchanges outside of its supply chain, see
+        `compile_reachability`. `solves_skipped` counts these.
+    reduce : bool
+        If True, only the sub-system of the activities in the supply chains
+        of the reference flows is factorized and solved, see
+        `reduce_technosphere`. The results keep the full index. With
+        `adjoint`, the `intensities` of products outside of these supply
+        chains are NaN.
+    full_inventory : bool
+        If False, the inventories only hold the biosphere rows with a
+        characterization factor, see `MLCA`.
+    screening : float, optional
+        If given, `calculate` estimates the scores of all scenarios with
+        `screen_scenarios` and only calculates the scenarios exactly whose
+        error indicator exceeds this threshold. The indicators are stored as
+        `screening_errors`, the exactly calculated scenarios as
+        `screening_flagged`. Requires `retain` "scores".
     """
 
     # Note: source: from activity-browser:
@@ -26,20 +214,91 @@ class SuperstructureMLCA(MLCA):
     # from: Lib\site-packages\activity_browser\bwutils\superstructure\mlca.py
     # branch: activity-browser-dev; version: 2022.11.16
     # adaptations: assert message for assert not df.empty, f"Filtering unused flows removed all of the scenario data."
+    # adaptations: batched solving of all reference flows per scenario (`batched`)
+    # adaptations: stacked characterization of all impact categories (`stacked`)
+    # adaptations: calculations split per scenario, parallel execution of scenarios (`processes`)
+    # adaptations: scenario results can be streamed with `iter_scenarios`
+    # adaptations: update_matrices uses a precompiled update plan (`compile_update_plan`)
+    #   and writes directly into the data arrays of the CSR matrices
+    # adaptations: technosphere factorizations reuse the symbolic analysis of the selectable `solver`
+    # adaptations: optional low-rank updates against the baseline factorization (`low_rank`)
+    # adaptations: results are only calculated and kept up to the `retain` level
+    # adaptations: optional memory-mapped result arrays (`results_dir`, `result_dtype`)
+    # adaptations: the scenario values are complete, so set_scenario jumps directly
+    #   to a scenario; `scenarios` calculates a subset of the scenarios
+    # adaptations: checkpointing of scenario results to `run_dir` and resuming from it
+    # adaptations: persistent result cache keyed by the scenario inputs (`cache`)
+    # adaptations: identical scenarios are solved once (`scenario_duplicates`)
+    # adaptations: optional similarity-based order of the calculations (`reorder`)
+    # adaptations: LRU cache of scenario factorizations for update_lca_calculation_for_sankey
+    # adaptations: optional impact intensities of all products from the adjoint system (`adjoint`)
+    # adaptations: scenarios which leave the technosphere unchanged reuse its
+    #   factorization and supply arrays
+    # adaptations: optional reachability pruning of reference flow solves (`prune`)
+    # adaptations: optional reduction of the technosphere to the supply chains (`reduce`)
+    # adaptations: the impact assessment only uses the `characterized_rows`, see `MLCA`
+    # adaptations: optional linearized screening of the scenario scores (`screening`)
 
     matrices = {
         "biosphere": "biosphere_matrix",
         "technosphere": "technosphere_matrix",
         "production": "technosphere_matrix",
     }
+    # Low-rank updates are only enabled once the update plan is compiled.
+    low_rank = False
 
-    def __init__(self, cs_name: str, df: pd.DataFrame):
+    def __init__(
+        self,
+        cs_name: str,
+        df: pd.DataFrame,
+        batched: bool = False,
+        stacked: bool = False,
+        processes: int = 1,
+        solver: Union[str, SparseSolver, None] = None,
+        low_rank: bool = False,
+        max_rank: Optional[int] = None,
+        retain: str = "full",
+        results_dir: Optional[pt.Path] = None,
+        result_dtype: Union[str, np.dtype] = np.float64,
+        scenarios: Optional[Iterable[Union[str, int]]] = None,
+        run_dir: Optional[pt.Path] = None,
+        cache: Union[ResultCache, pt.Path, str, None] = None,
+        reorder: bool = False,
+        factorization_memory: int = 2**28,
+        adjoint: bool = False,
+        prune: bool = False,
+        reduce: bool = False,
+        full_inventory: bool = True,
+        screening: Optional[float] = None,
+    ):
         assert not df.empty, "Cannot run analysis without data."
-        self.scenario_names = scenario_names_from_df(df)
+        assert (
+            screening is None or retain == "scores"
+        ), "Screening only estimates scores, use retain='scores'."
+        scenario_names = scenario_names_from_df(df)
+        if scenarios is None:
+            self.scenario_columns = list(range(len(scenario_names)))
+        else:
+            columns = set()
+            for scenario in scenarios:
+                if isinstance(scenario, str):
+                    assert (
+                        scenario in scenario_names
+                    ), f"Scenario '{scenario}' is not part of the scenario data."
+                    columns.add(scenario_names.index(scenario))
+                else:
+                    assert (
+                        0 <= scenario < len(scenario_names)
+                    ), f"Scenario index {scenario} is not part of the scenario data."
+                    columns.add(int(scenario))
+            self.scenario_columns = sorted(columns)
+        self.scenario_names = [scenario_names[i] for i in self.scenario_columns]
         self.total = len(self.scenario_names)
         assert self.total > 0, "Cannot run analysis without scenarios"
 
-        super().__init__(cs_name)
+        super().__init__(
+            cs_name, solver=solver, retain=retain, full_inventory=full_inventory
+        )
 
         # Filter dataframe for keys that do not occur in the LCA matrix.
         df = filter_databases_indexed_superstructure(df, self.all_databases)
@@ -63,31 +322,104 @@ class SuperstructureMLCA(MLCA):
             ],
         )
         self.indices_to_matrix()
+        self.adjoint = adjoint
+        self.reduce = reduce
+        self.stacked = stacked
+        # Hashed before the update plan extends the sparsity patterns.
+        self.setup_hash = self.calculation_setup_hash()
+        self.update_plan = self.compile_update_plan()
+        self.supply_chain_activities = None
+        self.supply_chain_products = None
+        self.supply_chain_biosphere = None
+        if reduce:
+            self.reduce_technosphere()
+        # Identical scenarios are only solved once.
+        self.scenario_duplicates = self.find_duplicate_scenarios()
+        self.solves_saved = self.total - len(np.unique(self.scenario_duplicates))
+        self.reorder = reorder
+        self.prune = prune
+        self.reachable_exchanges = self.compile_reachability() if prune else None
+        self.solves_skipped = 0
+        self._previous_result = None
+        self.screening = screening
+        self.screening_errors = None
+        self.screening_flagged = None
 
         # Construct an index dictionary similar to fu_index and method_index
         self._current_index = 0
         self.scenario_index = {k: i for i, k in enumerate(self.scenario_names)}
 
         # Rebuild numpy arrays with scenario dimension included.
-        self.lca_scores = np.zeros(
-            (len(self.func_units), len(self.methods), self.total)
+        self.results_dir = results_dir
+        self.lca_scores = result_array(
+            (len(self.func_units), len(self.methods), self.total),
+            result_dtype,
+            results_dir,
+            "lca_scores",
         )
-        self.elementary_flow_contributions = np.zeros(
-            (
-                len(self.func_units),
-                len(self.methods),
-                self.total,
-                self.lca.biosphere_matrix.shape[0],
+        if self.retains("contributions"):
+            self.elementary_flow_contributions = result_array(
+                (
+                    len(self.func_units),
+                    len(self.methods),
+                    self.total,
+                    self.lca.biosphere_matrix.shape[0],
+                ),
+                result_dtype,
+                results_dir,
+                "elementary_flow_contributions",
             )
-        )
-        self.process_contributions = np.zeros(
-            (
-                len(self.func_units),
-                len(self.methods),
-                self.total,
-                self.lca.technosphere_matrix.shape[0],
+            self.process_contributions = result_array(
+                (
+                    len(self.func_units),
+                    len(self.methods),
+                    self.total,
+                    self.lca.technosphere_matrix.shape[0],
+                ),
+                result_dtype,
+                results_dir,
+                "process_contributions",
+            )
+        self.intensities = None
+        if adjoint:
+            self.intensities = result_array(
+                (len(self.methods), self.total, self.lca.technosphere_matrix.shape[0]),
+                result_dtype,
+                results_dir,
+                "intensities",
             )
+
+        # Demand matrix with one column per reference flow, so that all
+        # reference flows can be solved at once in batched mode.
+        self.batched = batched
+        self.demand_matrix = np.zeros(
+            (len(self.lca.product_dict), len(self.func_units))
         )
+        for row, func_unit in enumerate(self.func_units):
+            self.lca.build_demand_array(func_unit)
+            self.demand_matrix[:, row] = self.lca.demand_array
+        self.lca.build_demand_array()
+        self.processes = max(1, min(processes, self.total))
+
+        self.low_rank = low_rank
+        self.max_rank = max_rank
+        self._base_solver = None
+        self._base_factorization = None
+        if low_rank:
+            self.prepare_low_rank_updates()
+        self.factorization_memory = factorization_memory
+        self._factorizations = collections.OrderedDict()
+        # Supply arrays by reference flow for `_supply_factorization`.
+        self._supplies = {}
+        self._supply_factorization = None
+
+        self.cache = cache
+        if cache is not None and not isinstance(cache, ResultCache):
+            self.cache = ResultCache(cache)
+        self.run_dir = None if run_dir is None else pt.Path(run_dir)
+        self.fingerprint = None
+        if run_dir is not None:
+            self.fingerprint = self.calculation_fingerprint(scenario_names)
 
     @property
     def current(self) -> int:
@@ -103,11 +435,15 @@ class SuperstructureMLCA(MLCA):
         self.current += 1
 
     def set_scenario(self, index: int) -> None:
-        """Set the current scenario index given a new index to go to"""
-        steps = self._get_steps_to_index(index)
-        # self.current = steps[-1] + 1  # Walk the steps to the new index
-        for _ in steps:
-            self.next_scenario()
+        """Apply the given scenario to the LCA matrices and make it the
+        current scenario.
+        """
+        if index < 0:
+            raise ValueError("Negative indexes are not allowed")
+        elif index >= self.total:
+            raise ValueError("Given index is not possible for current scenario dataset")
+        self.current = index
+        self.update_matrices()
 
     def indices_to_matrix(self) -> None:
         def convert(idx: Index) -> tuple:
@@ -125,78 +461,1015 @@ class SuperstructureMLCA(MLCA):
         for i, index in enumerate(self.indices):
             self.matrix_indices[i] = convert(index)
 
+    def exchange_matrices(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return for each superstructure exchange the name of the LCA matrix
+        it belongs to and the sign of its value in that matrix.
+        """
+        kinds = np.array([idx[2] for idx in self.indices])
+        matrix_names = np.array([self.matrices[kind] for kind in kinds])
+        # Technosphere inputs are consumed, so are negative.
+        signs = MB.fix_supply_use(self.matrix_indices, np.ones(len(kinds)))
+        signs[kinds != "technosphere"] = 1.0
+        return matrix_names, signs
+
+    def compile_update_plan(self) -> List[MatrixUpdate]:
+        """Prepare the scenario values once for fast matrix updates.
+
+        The superstructure exchanges are grouped by the LCA matrix they
+        belong to. For each matrix, the positions of the exchanges in the
+        data array of the CSR matrix and their values per scenario, with the
+        sign convention of `TechnosphereBiosphereMatrixBuilder` already
+        applied, are stored, so that `update_matrices` only needs to copy an
+        array.
+
+        Exchanges which are not yet part of the sparsity pattern of a matrix
+        are added to it as explicit zeros, so that the pattern stays the same
+        for all scenarios.
+
+        A NaN in the scenario data keeps the value of the previous scenario,
+        or of the original matrix for the first scenario. These values are
+        filled in here, so that each scenario can be applied on its own.
+        """
+        matrix_names, signs = self.exchange_matrices()
+        plan = []
+        for name in sorted(set(matrix_names)):
+            if not hasattr(self.lca, name):
+                continue
+            mask = matrix_names == name
+            rows = self.matrix_indices["row"][mask]
+            cols = self.matrix_indices["col"][mask]
+            matrix, slots = csr_data_slots(getattr(self.lca, name), rows, cols)
+            setattr(self.lca, name, matrix)
+            values = (self.values[mask] * signs[mask, None]).T
+            unique_slots, first, merged = merge_scenario_values(
+                values, slots, matrix.data
+            )
+            plan.append(
+                MatrixUpdate(
+                    matrix=name,
+                    rows=rows[first],
+                    cols=cols[first],
+                    slots=unique_slots,
+                    values=np.ascontiguousarray(merged[self.scenario_columns]),
+                    baseline=matrix.data[unique_slots].copy(),
+                )
+            )
+        return plan
+
+    def compile_reachability(self) -> List[List[np.ndarray]]:
+        """Find the superstructure exchanges in the supply chain of each
+        reference flow.
+
+        The activities reachable from a reference flow are found by a
+        traversal of the sparsity pattern of the technosphere matrix, which
+        includes all superstructure exchanges. Exchanges of other activities
+        cannot change the results of the reference flow.
+
+        Returns for each reference flow a list with a boolean mask over the
+        exchanges of each `MatrixUpdate` in `update_plan`.
+        """
+        return [
+            [reachable[update.cols] for update in self.update_plan]
+            for reachable in self.supply_chains()
+        ]
+
+    def product_producers(self) -> np.ndarray:
+        """Return for each product row of the technosphere matrix the column
+        of the activity producing it.
+        """
+        producer = np.arange(self.lca.technosphere_matrix.shape[0])
+        for key, row in self.lca.product_dict.items():
+            producer[row] = self.lca.activity_dict.get(key, row)
+        return producer
+
+    def supply_chains(self) -> List[np.ndarray]:
+        """Return for each reference flow a boolean mask of the activities in
+        its supply chain.
+
+        The activities are found by a traversal of the sparsity pattern of
+        the technosphere matrix, which includes all superstructure exchanges,
+        so the supply chains hold for all scenarios.
+        """
+        matrix = self.lca.technosphere_matrix.tocsc()
+        producer = self.product_producers()
+        # Edges lead from each activity to the activities producing its inputs.
+        graph = sparse.csr_matrix(
+            (np.ones(matrix.nnz), producer[matrix.indices], matrix.indptr),
+            shape=matrix.shape,
+        )
+        chains = []
+        for func_unit in self.func_units:
+            reachable = np.zeros(matrix.shape[1], dtype=bool)
+            for key in func_unit:
+                start = producer[self.lca.product_dict[key]]
+                reachable[
+                    csgraph.breadth_first_order(
+                        graph, start, directed=True, return_predecessors=False
+                    )
+                ] = True
+            chains.append(reachable)
+        return chains
+
+    def reduce_technosphere(self) -> None:
+        """Restrict the solver to the activities in the supply chains of the
+        reference flows and the products they produce.
+
+        The supply arrays are zero outside of the supply chains, so solving
+        the sub-system gives the same results with a smaller factorization.
+        The activity columns are stored as `supply_chain_activities`, their
+        products as `supply_chain_products` and the biosphere rows they use
+        as `supply_chain_biosphere`. The other biosphere rows are always zero
+        in the inventories, so the `characterized_rows` are restricted to the
+        supply chain biosphere rows.
+        """
+        activities = np.flatnonzero(np.logical_or.reduce(self.supply_chains()))
+        producer = self.product_producers()
+        product_of = np.argsort(producer)[activities]
+        self.supply_chain_activities = activities
+        self.supply_chain_products = product_of
+        self.supply_chain_biosphere = np.unique(
+            self.lca.biosphere_matrix.tocsc()[:, activities].indices
+        )
+        self.characterized_rows = np.intersect1d(
+            self.characterized_rows, self.supply_chain_biosphere
+        )
+        self._characterized_gather = None
+        self.solver = ReducedSolver(self.solver, product_of, activities)
+        # The full baseline factorization of `MLCA` is replaced.
+        self.lca.__dict__.pop("solver", None)
+        self._factorization = None
+
+    def unaffected_func_units(self, ps_col: int, other: int) -> List[int]:
+        """Return the reference flows whose supply chain has the same
+        exchange values in both scenarios, see `compile_reachability`.
+        """
+        return [
+            row
+            for row, masks in enumerate(self.reachable_exchanges)
+            if all(
+                np.array_equal(
+                    update.values[ps_col][mask], update.values[other][mask]
+                )
+                for update, mask in zip(self.update_plan, masks)
+            )
+        ]
+
     def update_matrices(self) -> None:
         """A Simplified version of the `PackagesDataLoader.update_matrices` method.
 
         In this case, we expect to only replace technosphere and biosphere
         values, leaving out characterization factor values.
+
+        The factorization of the technosphere matrix is only removed if the
+        scenario actually changes its values, so that scenarios which only
+        differ in biosphere values reuse it.
         """
-        kinds = set([idx[2] for idx in self.indices])
-        types = np.array([idx[2] for idx in self.indices])
-        for kind in kinds:
-            idx = self.matrix_indices[types == kind]
-            sample = self.values[types == kind, self.current]
-            # Filter sample and idx for NaN values in samples.
-            idx = idx[~np.isnan(sample)]
-            sample = sample[~np.isnan(sample)]
-            try:
-                matrix = getattr(self.lca, self.matrices[kind])
-            except AttributeError:
-                # This LCA doesn't have this matrix
-                continue
+        for update in self.update_plan:
+            matrix = getattr(self.lca, update.matrix)
+            values = update.values[self.current]
 
-            if self.matrices[kind] == "technosphere_matrix":
+            if update.matrix == "technosphere_matrix":
+                if np.array_equal(matrix.data[update.slots], values):
+                    continue
                 # Remove existing matrix factorization
                 # because changing technosphere
                 if hasattr(self.lca, "solver"):
                     delattr(self.lca, "solver")
 
-            if kind == "technosphere":
-                MB.fix_supply_use(idx, sample)
-            matrix[
-                idx["row"],
-                idx["col"],
-            ] = sample
+            matrix.data[update.slots] = values
 
     def _perform_calculations(self):
         """Near copy of `MLCA` class, but includes a loop for all scenarios."""
+        self.solves_skipped = 0
+        scenarios = range(self.total)
+        if self.screening is not None:
+            screening = self.screen_scenarios(self.screening)
+            self.lca_scores[:] = screening.lca_scores
+            self.screening_errors = screening.errors
+            self.screening_flagged = screening.flagged
+            scenarios = screening.flagged
+            print(
+                f"{len(scenarios)} of {self.total} scenarios exceed the screening "
+                f"error threshold and are calculated exactly."
+            )
+        completed = set()
+        if self.run_dir is not None:
+            completed = self.load_checkpoint()
+        remaining = []
+        for ps_col in scenarios:
+            if ps_col in completed:
+                continue
+            result = None
+            if self.cache is not None:
+                result = self.cache.get(self.scenario_cache_key(ps_col))
+            if result is None:
+                remaining.append(ps_col)
+                continue
+            result = result._replace(index=ps_col, name=self.scenario_names[ps_col])
+            self.store_scenario_result(result)
+            if self.run_dir is not None:
+                self.save_checkpoint(result)
+        if self.solves_saved:
+            print(
+                f"{self.solves_saved} of {self.total} scenarios are identical to "
+                f"another scenario, each distinct scenario is solved once."
+            )
+        for result in self.iter_scenarios(remaining):
+            self.store_scenario_result(result)
+            if self.run_dir is not None:
+                self.save_checkpoint(result)
+            if self.cache is not None:
+                key = self.scenario_cache_key(result.index)
+                if key not in self.cache:
+                    self.cache.put(key, result)
+        if self.solves_skipped:
+            print(
+                f"{self.solves_skipped} reference flow solves were skipped, the "
+                f"scenario did not change their supply chain."
+            )
+        self.flush_results()
+        self.set_scenario(0)
+
+    def calculation_setup_hash(self) -> str:
+        """Return a hash of the reference flows and impact categories of the
+        calculation setup, the `retain` level, the solver, the modes which
+        change the kept results, the characterization factors and the LCA
+        matrices, which reflect the state of the databases.
+        """
+        digest = hashlib.sha256()
+        setup = (self.func_units, self.methods, self.retain, self.solver_identity())
+        if self.adjoint:
+            # Reduced intensities only cover the supply chains.
+            setup += ("adjoint", "reduce") if self.reduce else ("adjoint",)
+        if self.stacked and self.retains("full"):
+            # Stacked runs keep no characterized inventories.
+            setup += ("stacked",)
+        if not self.full_inventory and self.retains("contributions"):
+            # The inventories only hold the characterized rows.
+            setup += ("characterized inventory",)
+        digest.update(repr(setup).encode())
+        digest.update(np.ascontiguousarray(self.characterization_factors).tobytes())
+        for name in ("technosphere_matrix", "biosphere_matrix"):
+            matrix = getattr(self.lca, name)
+            for array in (matrix.data, matrix.indices, matrix.indptr):
+                digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def solver_identity(self) -> str:
+        """Return the name of the solver and, for iterative solvers, whose
+        solutions are only as exact as their tolerance, the tolerance.
+        """
+        solver = self.solver
+        if isinstance(solver, ReducedSolver):
+            solver = solver.solver
+        if solver.iterative:
+            return "{} (tol={!r})".format(solver.name, solver.tol)
+        return solver.name
+
+    def calculation_fingerprint(self, scenario_names: List[str]) -> str:
+        """Return a hash of everything that determines the scenario results:
+        the scenario data and `setup_hash`, which covers the characterization
+        factors, the solver and the modes of the calculation.
+        """
+        digest = hashlib.sha256(self.setup_hash.encode())
+        digest.update(
+            repr((scenario_names, [tuple(index) for index in self.indices])).encode()
+        )
+        digest.update(np.ascontiguousarray(self.values).tobytes())
+        return digest.hexdigest()
+
+    def scenario_cache_key(self, ps_col: int) -> str:
+        """Return a hash of the inputs of a single scenario: `setup_hash` and
+        the matrix values the scenario applies, after filling in NaN values.
+        Scenarios with the same key have the same results.
+        """
+        digest = hashlib.sha256(self.setup_hash.encode())
+        for update in self.update_plan:
+            digest.update(update.matrix.encode())
+            digest.update(np.ascontiguousarray(update.rows).tobytes())
+            digest.update(np.ascontiguousarray(update.cols).tobytes())
+            digest.update(np.ascontiguousarray(update.values[ps_col]).tobytes())
+        return digest.hexdigest()
+
+    def invalidate_cache(self, scenarios: Optional[Iterable[int]] = None) -> None:
+        """Remove the results of the given scenario indexes, or of all
+        scenarios, of this calculation from the `cache`.
+        """
+        if self.cache is None:
+            return
+        scenarios = range(self.total) if scenarios is None else scenarios
+        self.cache.invalidate([self.scenario_cache_key(i) for i in scenarios])
+
+    def _checkpoint_path(self, ps_col: int) -> pt.Path:
+        # Named by the column in the scenario data, so that runs of a subset
+        # of the scenarios share the checkpoints.
+        return self.run_dir / "scenario_{:05d}.pkl".format(
+            self.scenario_columns[ps_col]
+        )
+
+    def calculation_modes(self) -> dict:
+        """Return the options which change the kept results, they are saved
+        next to the fingerprint of a checkpoint.
+        """
+        return {
+            "retain": self.retain,
+            "stacked": self.stacked,
+            "full_inventory": self.full_inventory,
+            "adjoint": self.adjoint,
+            "reduce": self.reduce,
+            "solver": self.solver_identity(),
+        }
+
+    def load_checkpoint(self) -> set:
+        """Load the scenario results saved in `run_dir` by a previous run
+        with the same fingerprint and return their indexes.
+
+        Results saved with a different fingerprint are outdated and are
+        removed from `run_dir`, so that results of different inputs or modes
+        are never mixed.
+        """
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        fingerprint_file = self.run_dir / "fingerprint.json"
+        previous = {}
+        if fingerprint_file.exists():
+            with open(fingerprint_file) as f:
+                previous = json.load(f)
+        modes = self.calculation_modes()
+        if previous.get("fingerprint") != self.fingerprint:
+            if previous:
+                changed = [
+                    name
+                    for name, mode in modes.items()
+                    if previous.get("modes", {}).get(name, mode) != mode
+                ]
+                print(
+                    f"Inputs changed since the checkpoint in {self.run_dir}"
+                    + (f" (modes: {', '.join(changed)})" if changed else "")
+                    + ", starting over."
+                )
+            for path in self.run_dir.glob("scenario_*.pkl"):
+                path.unlink()
+            with open(fingerprint_file, "w") as f:
+                json.dump({"fingerprint": self.fingerprint, "modes": modes}, f)
+            return set()
+        completed = set()
         for ps_col in range(self.total):
-            self.next_scenario()
-            for row, func_unit in enumerate(self.func_units):
-                self.lca.redo_lci(func_unit)
-                self.scaling_factors.update(
-                    {(str(func_unit), ps_col): self.lca.supply_array}
+            path = self._checkpoint_path(ps_col)
+            if path.exists():
+                with open(path, "rb") as f:
+                    result = pickle.load(f)
+                self.store_scenario_result(result._replace(index=ps_col))
+                completed.add(ps_col)
+        if completed:
+            print(
+                f"Resuming from the checkpoint in {self.run_dir}: "
+                f"{len(completed)} of {self.total} scenarios already calculated."
+            )
+        return completed
+
+    def save_checkpoint(self, result: ScenarioResult) -> None:
+        """Save the result of a scenario to `run_dir`."""
+        path = self._checkpoint_path(result.index)
+        temporary = path.with_suffix(".tmp")
+        with open(temporary, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Replacing is atomic, so an interrupted write leaves no broken file.
+        temporary.replace(path)
+
+    def scenario_values(self, indices: Optional[List[int]] = None) -> np.ndarray:
+        """Return the matrix values applied by the given scenarios, or by all
+        scenarios, as an array of shape (scenarios, exchanges).
+        """
+        indices = list(range(self.total)) if indices is None else list(indices)
+        return np.hstack(
+            [np.zeros((len(indices), 0))]
+            + [update.values[indices] for update in self.update_plan]
+        )
+
+    def find_duplicate_scenarios(self) -> np.ndarray:
+        """Return for each scenario the index of the first scenario which
+        applies exactly the same matrix values, after filling in NaN values.
+        """
+        return duplicate_scenarios(self.scenario_values())
+
+    def order_scenarios(self, indices: List[int]) -> List[int]:
+        """Order the given scenarios along a short path through the scenario
+        space, so that consecutive scenarios change the matrices as little as
+        possible.
+
+        Starting from the first scenario, the path greedily continues with
+        the nearest remaining scenario by the L1 distance of the applied
+        matrix values.
+        """
+        indices = list(indices)
+        order = greedy_scenario_order(self.scenario_values(indices))
+        return [indices[i] for i in order]
+
+    def iter_scenarios(
+        self, indices: Optional[Iterable[int]] = None
+    ) -> Iterator[ScenarioResult]:
+        """Calculate the scenarios one by one and yield the result of each
+        scenario as soon as it is available.
+
+        `indices` selects the scenarios to calculate, defaults to all.
+
+        Scenarios which are identical to another scenario (see
+        `scenario_duplicates`) are only calculated once, their results are
+        yielded right after each other. Otherwise the results are yielded in
+        order, or in the order of `order_scenarios` if `reorder` is set. Each
+        result holds the `index` of its scenario.
+
+        The results are not stored in this object, so only the results of
+        the scenario being calculated are kept in memory. Use `retain` to
+        limit what the results hold. With `processes` > 1, the scenarios are
+        calculated by a pool of worker processes, each owning a copy of this
+        object and its LCA. At most two scenarios per process are submitted
+        ahead of the one being yielded, so results do not pile up when they
+        are consumed slowly.
+        """
+        indices = range(self.total) if indices is None else indices
+        groups = {}
+        for ps_col in indices:
+            groups.setdefault(self.scenario_duplicates[ps_col], []).append(ps_col)
+        representatives = list(groups)
+        if self.reorder:
+            representatives = self.order_scenarios(representatives)
+        for result in self._calculate_scenarios(representatives):
+            for ps_col in groups[result.index]:
+                yield result._replace(index=ps_col, name=self.scenario_names[ps_col])
+
+    def _calculate_scenarios(self, indices: List[int]) -> Iterator[ScenarioResult]:
+        """Calculate the given scenarios and yield their results in order,
+        see `iter_scenarios`.
+        """
+        if self.processes == 1 or len(indices) < 2:
+            for ps_col in indices:
+                self.set_scenario(ps_col)
+                result = self.calculate_scenario(ps_col)
+                self.solves_skipped += result.solves_skipped
+                yield result
+            return
+        pool = multiprocessing.Pool(
+            processes=self.processes,
+            initializer=_initialize_worker,
+            initargs=(self._worker_copy(),),
+        )
+        try:
+            scenarios = iter(indices)
+            pending = collections.deque(
+                pool.apply_async(_calculate_scenario_worker, (ps_col,))
+                for ps_col in itertools.islice(scenarios, 2 * self.processes)
+            )
+            while pending:
+                result = pending.popleft().get()
+                for ps_col in itertools.islice(scenarios, 1):
+                    pending.append(
+                        pool.apply_async(_calculate_scenario_worker, (ps_col,))
+                    )
+                self.solves_skipped += result.solves_skipped
+                yield result
+        finally:
+            # Let the submitted scenarios finish, terminating the pool while
+            # workers are busy can deadlock.
+            pool.close()
+            pool.join()
+
+    def _worker_copy(self) -> "SuperstructureMLCA":
+        """Return a copy of this object to send to a worker process, without
+        factorizations and result buffers.
+        """
+        worker = copy.copy(self)
+        worker.lca = copy.copy(self.lca)
+        worker.lca.__dict__.pop("solver", None)
+        worker._factorization = None
+        worker._base_factorization = None
+        worker._factorizations = collections.OrderedDict()
+        worker._supplies = {}
+        worker._supply_factorization = None
+        worker._previous_result = None
+        worker.processes = 1
+        for name in (
+            "lca_scores",
+            "elementary_flow_contributions",
+            "process_contributions",
+            "scaling_factors",
+            "technosphere_flows",
+            "inventory",
+            "inventories",
+            "characterized_inventories",
+            "intensities",
+        ):
+            setattr(worker, name, None)
+        return worker
+
+    def flush_results(self) -> None:
+        """Write the memory-mapped result arrays to disk, see `results_dir`."""
+        for array in (
+            self.lca_scores,
+            self.elementary_flow_contributions,
+            self.process_contributions,
+            self.intensities,
+        ):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def calculate_scenario(self, ps_col: int) -> ScenarioResult:
+        """Calculate all reference flows and impact categories for the
+        scenario currently applied to the LCA matrices.
+
+        Only the results up to the `retain` level are calculated, the other
+        fields of the returned result are None. With `adjoint`, the
+        `intensities` are solved from the transposed system with the same
+        factorization.
+
+        If the technosphere matrix is unchanged since the previous scenario,
+        e.g. because only biosphere values differ, its factorization and
+        supply arrays are reused and only the inventories and impact
+        assessment are recalculated. With `prune`, the results of reference
+        flows which the scenario does not affect are copied from the
+        previously calculated scenario.
+        """
+        n_fu, n_methods = len(self.func_units), len(self.methods)
+        contributions, full = self.retains("contributions"), self.retains("full")
+        result = ScenarioResult(
+            index=ps_col,
+            name=self.scenario_names[ps_col],
+            lca_scores=np.zeros((n_fu, n_methods)),
+            elementary_flow_contributions=np.zeros(
+                (n_fu, n_methods, self.lca.biosphere_matrix.shape[0])
+            )
+            if contributions
+            else None,
+            process_contributions=np.zeros(
+                (n_fu, n_methods, self.lca.technosphere_matrix.shape[0])
+            )
+            if contributions
+            else None,
+            scaling_factors={} if contributions else None,
+            technosphere_flows={} if contributions else None,
+            inventory={} if contributions else None,
+            inventories={} if full else None,
+            characterized_inventories={} if full else None,
+        )
+        previous = self._previous_result
+        unaffected = []
+        if self.prune and previous is not None:
+            unaffected = self.unaffected_func_units(ps_col, previous.index)
+            result = result._replace(solves_skipped=len(unaffected))
+        rows = [row for row in range(n_fu) if row not in unaffected]
+        if rows or self.adjoint:
+            self.factorize_technosphere()
+            if self._supply_factorization is not self._factorization:
+                self._supplies = {}
+                self._supply_factorization = self._factorization
+        diagonal = self.lca.technosphere_matrix.diagonal()
+        if self.batched or self.solver.iterative:
+            rows_to_solve = [row for row in rows if row not in self._supplies]
+            if rows_to_solve:
+                supply = self.solve_all_func_units(rows_to_solve)
+                self._supplies.update(zip(rows_to_solve, supply))
+        # Without characterized inventories, the stacked characterization
+        # gives the same scores and contributions with less work.
+        stacked = self.stacked or not full
+        if (stacked and contributions) or self.adjoint:
+            characterized_biosphere = self.characterize_biosphere()
+        if self.adjoint:
+            intensities = self.solve_intensities(
+                self.lca.solver, characterized_biosphere
+            )
+            if self.reduce:
+                # The reduced system has no intensities outside the supply chains.
+                outside = np.ones(intensities.shape[1], dtype=bool)
+                outside[self.supply_chain_products] = False
+                intensities[:, outside] = np.nan
+            result = result._replace(intensities=intensities)
+        if not (full or (contributions and self.full_inventory)):
+            # Only the characterized rows of the inventory are needed.
+            biosphere = self.characterized_biosphere_matrix()
+        else:
+            biosphere = self.lca.biosphere_matrix
+        for row, func_unit in enumerate(self.func_units):
+            if row in unaffected:
+                self.copy_func_unit_result(previous, result, row)
+                continue
+            if row not in self._supplies:
+                self.lca.build_demand_array(func_unit)
+                self._supplies[row] = self.lca.solve_linear_system()
+            characterized = self.set_supply_array(
+                self._supplies[row], build_inventory=full
+            )
+            if full:
+                inventory = np.array(self.lca.inventory.sum(axis=1)).ravel()
+                result.inventories[row] = self.lca.inventory
+            else:
+                inventory = biosphere @ self.lca.supply_array
+            if contributions:
+                result.scaling_factors[row] = self.lca.supply_array
+                result.technosphere_flows[row] = np.multiply(
+                    self.lca.supply_array, diagonal
                 )
-                self.technosphere_flows.update(
-                    {
-                        (str(func_unit), ps_col): np.multiply(
-                            self.lca.supply_array,
-                            self.lca.technosphere_matrix.diagonal(),
-                        )
-                    }
+                result.inventory[row] = inventory
+
+            if not contributions:
+                result.lca_scores[row] = self.characterization_factors @ inventory
+                continue
+            if stacked:
+                result.lca_scores[row] = characterized_biosphere @ self.lca.supply_array
+                result.elementary_flow_contributions[row] = (
+                    self.characterization_factors * inventory
                 )
-                self.inventory.update(
-                    {
-                        (str(func_unit), ps_col): np.array(
-                            self.lca.inventory.sum(axis=1)
-                        ).ravel()
-                    }
+                result.process_contributions[row] = (
+                    characterized_biosphere * self.lca.supply_array
                 )
-                self.inventories.update({(str(func_unit), ps_col): self.lca.inventory})
-
-                for col, cf_matrix in enumerate(self.method_matrices):
-                    self.lca.characterization_matrix = cf_matrix
-                    self.lca.lcia_calculation()
-                    self.lca_scores[row, col, ps_col] = self.lca.score
-                    self.characterized_inventories[
-                        (row, col, ps_col)
-                    ] = self.lca.characterized_inventory.copy()
-                    self.elementary_flow_contributions[row, col, ps_col] = np.array(
-                        self.lca.characterized_inventory.sum(axis=1)
-                    ).ravel()
-                    self.process_contributions[
-                        row, col, ps_col
-                    ] = self.lca.characterized_inventory.sum(axis=0)
+                continue
+
+            for col, cf_matrix in enumerate(self.method_matrices):
+                self.characterize_inventory(cf_matrix, characterized)
+                result.lca_scores[row, col] = self.lca.score
+                result.characterized_inventories[
+                    (row, col)
+                ] = self.lca.characterized_inventory.copy()
+                result.elementary_flow_contributions[row, col] = np.array(
+                    self.lca.characterized_inventory.sum(axis=1)
+                ).ravel()
+                result.process_contributions[
+                    row, col
+                ] = self.lca.characterized_inventory.sum(axis=0)
+        if self.prune:
+            self._previous_result = result
+        return result
+
+    def copy_func_unit_result(
+        self, source: ScenarioResult, target: ScenarioResult, row: int
+    ) -> None:
+        """Copy the results of one reference flow between scenario results."""
+        target.lca_scores[row] = source.lca_scores[row]
+        if self.retains("contributions"):
+            target.elementary_flow_contributions[
+                row
+            ] = source.elementary_flow_contributions[row]
+            target.process_contributions[row] = source.process_contributions[row]
+            target.scaling_factors[row] = source.scaling_factors[row]
+            target.technosphere_flows[row] = source.technosphere_flows[row]
+            target.inventory[row] = source.inventory[row]
+        if self.retains("full"):
+            target.inventories[row] = source.inventories[row]
+            for col in range(len(self.methods)):
+                if (row, col) in source.characterized_inventories:
+                    target.characterized_inventories[
+                        (row, col)
+                    ] = source.characterized_inventories[(row, col)]
+
+    def store_scenario_result(self, result: ScenarioResult) -> None:
+        """Write the results of a single scenario into the result arrays and
+        dictionaries of this object.
+        """
+        ps_col = result.index
+        self.lca_scores[:, :, ps_col] = result.lca_scores
+        if self.retains("contributions"):
+            self.elementary_flow_contributions[
+                :, :, ps_col
+            ] = result.elementary_flow_contributions
+            self.process_contributions[:, :, ps_col] = result.process_contributions
+            for row, func_unit in enumerate(self.func_units):
+                key = (str(func_unit), ps_col)
+                self.scaling_factors[key] = result.scaling_factors[row]
+                self.technosphere_flows[key] = result.technosphere_flows[row]
+                self.inventory[key] = result.inventory[row]
+        if self.retains("full"):
+            for row, func_unit in enumerate(self.func_units):
+                self.inventories[(str(func_unit), ps_col)] = result.inventories[row]
+            for (row, col), matrix in result.characterized_inventories.items():
+                self.characterized_inventories[(row, col, ps_col)] = matrix
+        if self.adjoint:
+            self.intensities[:, ps_col] = result.intensities
+
+    def solve_intensities(
+        self, solve: Callable, characterized_biosphere: np.ndarray
+    ) -> np.ndarray:
+        """Return the intensities lambda = A^-T B^T c of all impact categories c,
+        an array of shape (`methods`, `technosphere`), from the transposed solve
+        of a factorization of A and the characterized biosphere B^T c, see
+        `characterize_biosphere`.
+
+        With `reduce`, the intensities outside of the supply chains are zero.
+        """
+        return (
+            solve.transposed(characterized_biosphere.T)
+            .reshape(-1, len(self.methods))
+            .T
+        )
+
+    def screen_scenarios(self, threshold: float = 0.01) -> ScreeningResult:
+        """Estimate the scores of all scenarios by a first-order perturbation
+        of the baseline system.
+
+        The baseline technosphere matrix is factorized once and solved for
+        the supply arrays s of all reference flows and, transposed, for the
+        intensities lambda of all impact categories. The score change of a
+        scenario with the changes dA and dB of the technosphere and biosphere
+        matrices is then estimated as c^T dB s - lambda^T dA s.
+
+        The error indicator of each score is the size of the second-order
+        term, c^T dB s1 - lambda^T dA s1 with s1 = -A^-1 dA s, relative to the
+        estimate. It costs one solve with the baseline factorization per
+        scenario.
+
+        Parameters
+        ----------
+        threshold : float
+            Scenarios with an error indicator above this value are flagged.
+
+        Returns
+        -------
+        ScreeningResult
+        """
+        technosphere = self.lca.technosphere_matrix.copy()
+        biosphere = self.lca.biosphere_matrix.copy()
+        for update in self.update_plan:
+            matrix = technosphere if update.matrix == "technosphere_matrix" else biosphere
+            matrix.data[update.slots] = update.baseline
+        # A separate solver keeps the factorization of the current scenario.
+        solver = copy.deepcopy(self.solver)
+        try:
+            solve = solver.factorize(technosphere)
+            cf = self.characterization_factors
+            supply = solve(self.demand_matrix).reshape(self.demand_matrix.shape)
+            intensities = self.solve_intensities(solve, (biosphere.T @ cf.T).T)
+            baseline_scores = (cf @ (biosphere @ supply)).T
+            scores = np.zeros((len(self.func_units), len(self.methods), self.total))
+            errors = np.zeros_like(scores)
+            for ps_col in range(self.total):
+                # (sign, weights, change matrix) per updated matrix.
+                changes = []
+                technosphere_change = None
+                for update in self.update_plan:
+                    delta = update.values[ps_col] - update.baseline
+                    change = sparse.csr_matrix(
+                        (delta, (update.rows, update.cols)),
+                        shape=getattr(self.lca, update.matrix).shape,
+                    )
+                    if update.matrix == "technosphere_matrix":
+                        changes.append((-1, intensities, change))
+                        technosphere_change = change
+                    else:
+                        changes.append((1, cf, change))
+                first = np.zeros_like(baseline_scores)
+                for sign, weights, change in changes:
+                    first += sign * (weights @ (change @ supply)).T
+                second = np.zeros_like(first)
+                if technosphere_change is not None:
+                    first_supply = -solve(technosphere_change @ supply).reshape(
+                        supply.shape
+                    )
+                    for sign, weights, change in changes:
+                        second += sign * (weights @ (change @ first_supply)).T
+                estimate = baseline_scores + first
+                scale = np.maximum(np.abs(estimate), np.abs(baseline_scores))
+                scores[:, :, ps_col] = estimate
+                errors[:, :, ps_col] = np.abs(second) / np.where(scale > 0, scale, 1)
+        finally:
+            solver.release()
+        flagged = [
+            ps_col
+            for ps_col in range(self.total)
+            if np.any(errors[:, :, ps_col] > threshold)
+        ]
+        return ScreeningResult(lca_scores=scores, errors=errors, flagged=flagged)
+
+    def exchange_sensitivities(
+        self,
+        scenarios: Optional[Iterable[Union[str, int]]] = None,
+        top: Optional[int] = None,
+        labels: bool = True,
+    ) -> pd.DataFrame:
+        """Return the derivatives of the scores with respect to the amount of
+        every superstructure exchange in `indices`, ranked by their absolute
+        value per scenario, reference flow and impact category.
+
+        For the score h = c^T B A^-1 f, the derivatives with respect to the
+        matrix entries are dh/dA_ij = -lambda_i s_j and dh/dB_ij = c_i s_j,
+        with the supply array s and the intensities lambda = A^-T B^T c. Per
+        scenario, this takes one solve for all reference flows and one
+        transposed solve for all impact categories.
+
+        Parameters
+        ----------
+        scenarios : list, optional
+            Names or indices of the scenarios, defaults to all scenarios.
+        top : int, optional
+            Only return the `top` exchanges with the largest absolute
+            derivative per scenario, reference flow and impact category.
+        labels : bool
+            If True, the inputs and outputs are labelled with their metadata.
+
+        Returns
+        -------
+        `pandas.DataFrame`
+            One row per scenario, reference flow, impact category and
+            exchange, with the derivative as "sensitivity" and its "rank".
+        """
+        if scenarios is None:
+            scenarios = range(self.total)
+        scenarios = [
+            self.scenario_index[scenario] if isinstance(scenario, str) else scenario
+            for scenario in scenarios
+        ]
+        names, signs = self.exchange_matrices()
+        technosphere = names == "technosphere_matrix"
+        exchanges = pd.DataFrame(
+            [tuple(index)[:3] for index in self.indices],
+            columns=["input", "output", "flow type"],
+        )
+        if labels:
+            self.get_all_metadata()
+            for column in ("input", "output"):
+                keys = list(dict.fromkeys(exchanges[column]))
+                translated = dict(zip(keys, Contributions.get_labels(keys)))
+                exchanges[column + " label"] = exchanges[column].map(translated)
+        current = self.current
+        frames = []
+        for ps_col in scenarios:
+            self.set_scenario(ps_col)
+            supply = self.solve_all_func_units()
+            intensities = self.solve_intensities(
+                self.lca.solver, self.characterize_biosphere()
+            )
+            weights = np.where(
+                technosphere,
+                -intensities[:, np.where(technosphere, self.matrix_indices["row"], 0)],
+                self.characterization_factors[
+                    :, np.where(technosphere, 0, self.matrix_indices["row"])
+                ],
+            )
+            weights *= signs
+            for row, func_unit in enumerate(self.fu_activity_keys):
+                sensitivities = weights * supply[row, self.matrix_indices["col"]]
+                for col, method in enumerate(self.methods):
+                    order = np.argsort(-np.abs(sensitivities[col]), kind="stable")
+                    if top is not None:
+                        order = order[:top]
+                    frame = exchanges.iloc[order].reset_index(drop=True)
+                    frame.insert(0, "scenario", self.scenario_names[ps_col])
+                    frame.insert(1, "reference flow", [func_unit] * len(frame))
+                    frame.insert(2, "method", [method] * len(frame))
+                    frame.insert(3, "rank", np.arange(1, len(frame) + 1))
+                    frame["sensitivity"] = sensitivities[col, order]
+                    frames.append(frame)
+        self.set_scenario(current)
+        return pd.concat(frames, ignore_index=True)
+
+    def prepare_low_rank_updates(self) -> None:
+        """Store the baseline values of the technosphere entries changed by
+        the scenarios and factorize the baseline technosphere matrix.
+
+        If `max_rank` is not given, it is set to the number of solves with
+        the baseline factorization that take as long as one factorization.
+        """
+        matrix = self.lca.technosphere_matrix
+        slots = np.unique(
+            np.concatenate(
+                [np.zeros(0, dtype=np.int64)]
+                + [
+                    update.slots
+                    for update in self.update_plan
+                    if update.matrix == "technosphere_matrix"
+                    and update.slots is not None
+                ]
+            )
+        )
+        entry_rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        if self.reduce:
+            # Changes outside of the supply chains do not affect the results.
+            slots = slots[np.isin(matrix.indices[slots], self.supply_chain_activities)]
+        self._change_slots = slots
+        self._change_rows = entry_rows[slots]
+        self._change_cols = matrix.indices[slots]
+        self._base_values = matrix.data[slots].copy()
+        self.factorize_baseline()
+        if self.max_rank is None:
+            # Time the numeric factorization only, the analysis is done.
+            start = time.perf_counter()
+            self.factorize_baseline()
+            factorize_time = time.perf_counter() - start
+            start = time.perf_counter()
+            self._base_factorization(np.ones(matrix.shape[0]))
+            solve_time = time.perf_counter() - start
+            self.max_rank = int(factorize_time / max(solve_time, 1e-9))
+
+    def factorize_baseline(self) -> None:
+        """Factorize the baseline technosphere matrix with a separate solver
+        instance, so that it is kept while scenarios are factorized.
+        """
+        if self._base_solver is None:
+            self._base_solver = copy.deepcopy(self.solver)
+        matrix = self.lca.technosphere_matrix.copy()
+        matrix.data[self._change_slots] = self._base_values
+        self._base_factorization = self._base_solver.factorize(matrix)
+
+    def factorize_technosphere(self) -> None:
+        """Factorize the current technosphere matrix, see `MLCA`.
+
+        With `low_rank`, the changed columns of the technosphere matrix are
+        applied as a low-rank update to the baseline factorization instead,
+        unless there are more than `max_rank` of them.
+        """
+        solver = getattr(self.lca, "solver", None)
+        if not self.low_rank or (solver is not None and solver is self._factorization):
+            return super().factorize_technosphere()
+        matrix = self.lca.technosphere_matrix
+        change = matrix.data[self._change_slots] - self._base_values
+        changed = np.flatnonzero(change)
+        columns = np.unique(self._change_cols[changed])
+        if len(columns) > self.max_rank:
+            return super().factorize_technosphere()
+        if self._base_factorization is None:
+            self.factorize_baseline()
+        delta = np.zeros((matrix.shape[0], len(columns)))
+        delta[
+            self._change_rows[changed],
+            np.searchsorted(columns, self._change_cols[changed]),
+        ] = change[changed]
+        self._factorization = low_rank_update(
+            self._base_factorization, columns, delta
+        )
+        self.lca.solver = self._factorization
+
+    def factorize_cached(self) -> None:
+        """Factorize the technosphere matrix of the current scenario, reusing
+        the factorization of a recently visited identical scenario if it is
+        still kept, see `factorization_memory`.
+
+        Solvers which can only solve with their latest factorization get a
+        separate copy of the solver for each kept factorization.
+        """
+        key = int(self.scenario_duplicates[self.current])
+        if key in self._factorizations:
+            self._factorizations.move_to_end(key)
+            self._factorization = self._factorizations[key][1]
+            self.lca.solver = self._factorization
+            return
+        solver = self.solver
+        if not solver.reusable:
+            self.solver = copy.deepcopy(solver)
+        try:
+            self.lca.__dict__.pop("solver", None)
+            self.factorize_technosphere()
+            self._factorizations[key] = (self.solver, self._factorization)
+        finally:
+            self.solver = solver
+        self.evict_factorizations()
+
+    def evict_factorizations(self) -> None:
+        """Drop the least recently used kept factorizations until they fit in
+        `factorization_memory`. The latest factorization is always kept.
+        """
+        size = sum(
+            getattr(factorization, "nbytes", 0)
+            for _, factorization in self._factorizations.values()
+        )
+        while len(self._factorizations) > 1 and size > self.factorization_memory:
+            solver, factorization = self._factorizations.popitem(last=False)[1]
+            size -= getattr(factorization, "nbytes", 0)
+            if solver is not self.solver:
+                solver.release()
+
+    def clear_factorizations(self) -> None:
+        """Drop all kept factorizations, see `factorization_memory`."""
+        for solver, _ in self._factorizations.values():
+            if solver is not self.solver:
+                solver.release()
+        self._factorizations.clear()
+
+    def solve_all_func_units(self, rows: Optional[List[int]] = None) -> np.ndarray:
+        """Solve the current technosphere matrix for all reference flows, or
+        the given ones, at once.
+
+        Returns an array of shape (`func_units`, `technosphere`) holding the
+        supply array of each reference flow.
+        """
+        self.factorize_technosphere()
+        rows = range(len(self.func_units)) if rows is None else rows
+        demand = self.demand_matrix[:, rows]
+        if self.solver.iterative:
+            # Warm-start each reference flow from its own previous solution.
+            supply = self.lca.solver(demand, columns=[("demand", row) for row in rows])
+        else:
+            supply = self.lca.solver(demand)
+        return np.ascontiguousarray(supply.T)
+
+    def set_supply_array(
+        self, supply_array: np.ndarray, build_inventory: bool = True
+    ) -> Optional[sparse.spmatrix]:
+        """Set a precalculated supply array on the LCA object and rebuild the
+        inventory from it, see `MLCA.build_inventory`, which returns the
+        inventory of the characterized rows.
+
+        With `build_inventory` False, the inventory matrix is left as it is.
+        """
+        self.lca.supply_array = supply_array
+        if build_inventory:
+            return self.build_inventory()
 
     def update_lca_calculation_for_sankey(
         self, scenario_index: int, func_unit: str, method_index: int
@@ -211,10 +1484,36 @@ class SuperstructureMLCA(MLCA):
         """
         self.current = scenario_index
         self.update_matrices()
+        if self.factorization_memory > 0:
+            self.factorize_cached()
+        else:
+            self.factorize_technosphere()
         self.lca.redo_lci(func_unit)
         self.lca.characterization_matrix = self.method_matrices[method_index]
         self.lca.lcia_calculation()
-        self.lca.decompose_technosphere()
+
+    def score_demand(self, demand: dict) -> np.ndarray:
+        """Return the scores of a demand, given as {activity key: amount},
+        from the `intensities` of the `adjoint` calculation, as an array of
+        shape (methods, scenarios).
+        """
+        assert self.adjoint, "Scoring a demand needs an adjoint calculation."
+        rows = [self.lca.product_dict[key] for key in demand]
+        amounts = np.array(list(demand.values()), dtype=float)
+        return self.intensities[:, :, rows] @ amounts
+
+    def activity_intensities(self, method_index: int = 0) -> pd.DataFrame:
+        """Return the score per unit of every product in the technosphere for
+        a method, with the product keys as index and the scenarios as
+        columns, from the `intensities` of the `adjoint` calculation.
+        """
+        assert self.adjoint, "Activity intensities need an adjoint calculation."
+        keys = sorted(self.lca.product_dict, key=self.lca.product_dict.get)
+        return pd.DataFrame(
+            np.asarray(self.intensities[method_index]).T,
+            index=pd.Index(keys),
+            columns=self.scenario_names,
+        )
 
     def get_results_for_method(self, index: int = 0) -> pd.DataFrame:
         """Overrides the parent and returns a dataframe with the scenarios
@@ -223,23 +1522,6 @@ class SuperstructureMLCA(MLCA):
         data = self.lca_scores[:, index, :]
         return pd.DataFrame(data, index=self.func_key_list, columns=self.scenario_names)
 
-    def _get_steps_to_index(self, index: int) -> list:
-        """Determine how many steps to take when given the index we want
-         to land on.
-
-        We can only iterate through the presample arrays in one direction, so
-         if we go from 2 to 1 we need to calculate the amount of steps to loop
-         around to 1.
-        """
-        if index < 0:
-            raise ValueError("Negative indexes are not allowed")
-        elif index >= self.total:
-            raise ValueError("Given index is not possible for current scenario dataset")
-        if index < self.current:
-            return [*range(self.current, self.total), *range(index)]
-        else:
-            return list(range(self.current, index))
-
     def lca_scores_to_dataframe(self) -> pd.DataFrame:
         """Returns a dataframe of LCA scores using FU labels as index and
         the product of methods and scenarios as columns.
@@ -268,6 +1550,7 @@ class SuperstructureContributions(Contributions):
     # class: class SuperstructureContributions(Contributions):
     # from: Lib\site-packages\activity_browser\bwutils\superstructure\mlca.py
     # branch: activity-browser-dev; version: 2022.11.16
+    # adaptations: contribution slices are read as arrays, so memory-mapped results are read lazily
 
     def __init__(self, mlca):
         if not isinstance(mlca, SuperstructureMLCA):
@@ -291,14 +1574,15 @@ class SuperstructureContributions(Contributions):
     def _build_contributions(
         self, data: np.ndarray, index: int, axis: int
     ) -> np.ndarray:
+        # Only read the requested slice if the results are memory-mapped.
         data = data[:, :, self.mlca.current]
-        return super()._build_contributions(data, index, axis)
+        return np.asarray(super()._build_contributions(data, index, axis))
 
     @staticmethod
     def _build_scenario_contributions(
         data: np.ndarray, fu_index: int, m_index: int
     ) -> np.ndarray:
-        return data[fu_index, m_index, :]
+        return np.asarray(data[fu_index, m_index, :])
 
     def get_contributions(
         self, contribution, functional_unit=None, method=None
@@ -0,0 +1,102 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+# arrays.py only depends on numpy, scipy and pandas, load it without the package,
+# which imports brightway2.
+_spec = importlib.util.spec_from_file_location(
+    "arrays",
+    Path(__file__).parents[1] / "bw_superstructure" / "superstructure" / "arrays.py",
+)
+arrays = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(arrays)
+
+
+def test_csr_data_slots_existing_entries():
+    matrix = sparse.csr_matrix(np.array([[1.0, 0, 2], [0, 3, 0], [4, 0, 5]]))
+    rows, cols = np.array([2, 0, 1]), np.array([2, 0, 1])
+    extended, slots = arrays.csr_data_slots(matrix, rows, cols)
+    assert extended.nnz == matrix.nnz
+    np.testing.assert_array_equal(extended.data[slots], [5, 1, 3])
+
+
+def test_csr_data_slots_missing_entries():
+    matrix = sparse.csr_matrix(np.array([[1.0, 0, 2], [0, 3, 0], [4, 0, 5]]))
+    rows, cols = np.array([1, 0, 2]), np.array([0, 1, 2])
+    extended, slots = arrays.csr_data_slots(matrix, rows, cols)
+    # The missing entries are explicit zeros, the matrix values are unchanged.
+    assert extended.nnz == matrix.nnz + 2
+    assert extended.has_canonical_format
+    np.testing.assert_array_equal(extended.toarray(), matrix.toarray())
+    extended.data[slots] = [10, 20, 30]
+    expected = matrix.toarray()
+    expected[rows, cols] = [10, 20, 30]
+    np.testing.assert_array_equal(extended.toarray(), expected)
+
+
+def test_csr_data_slots_duplicates():
+    # Duplicate entries of the input are summed.
+    matrix = sparse.csr_matrix(
+        (np.array([1.0, 2.0]), (np.array([0, 0]), np.array([1, 1]))), shape=(2, 2)
+    )
+    extended, slots = arrays.csr_data_slots(matrix, np.array([0]), np.array([1]))
+    assert extended.nnz == 1
+    assert extended.data[slots[0]] == 3
+
+
+def test_merge_scenario_values():
+    nan = np.nan
+    current = np.array([7.0, 8.0, 9.0])
+    # Three scenarios, four exchanges of which the last two share slot 2.
+    values = np.array(
+        [
+            [1.0, nan, nan, 3.0],
+            [nan, 2.0, 4.0, nan],
+            [5.0, nan, nan, nan],
+        ]
+    )
+    slots, first, merged = arrays.merge_scenario_values(
+        values, np.array([0, 1, 2, 2]), current
+    )
+    np.testing.assert_array_equal(slots, [0, 1, 2])
+    np.testing.assert_array_equal(first, [0, 1, 2])
+    np.testing.assert_array_equal(
+        merged,
+        [
+            # NaN in the first scenario keeps the current matrix value.
+            [1.0, 8.0, 3.0],
+            # NaN keeps the value of the previous scenario.
+            [1.0, 2.0, 4.0],
+            [5.0, 2.0, 4.0],
+        ],
+    )
+
+
+def test_duplicate_scenarios():
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+    np.testing.assert_array_equal(arrays.duplicate_scenarios(values), [0, 1, 0, 1, 4])
+
+
+def test_greedy_scenario_order():
+    values = np.array([[0.0], [10.0], [1.0], [9.0], [2.0]])
+    assert arrays.greedy_scenario_order(values) == [0, 2, 4, 3, 1]
+    assert arrays.greedy_scenario_order(values[:2]) == [0, 1]
+    assert arrays.greedy_scenario_order(np.zeros((0, 1))) == []
+
+
+def test_result_array_in_memory():
+    array = arrays.result_array((2, 3), "float32")
+    assert isinstance(array, np.ndarray) and not isinstance(array, np.memmap)
+    assert array.dtype == np.float32 and not array.any()
+
+
+def test_result_array_memory_mapped(tmp_path):
+    directory = tmp_path / "results"
+    array = arrays.result_array((2, 3), np.float64, directory, "lca_scores")
+    assert isinstance(array, np.memmap)
+    array[1, 2] = 4.0
+    array.flush()
+    loaded = np.load(directory / "lca_scores.npy", mmap_mode="r")
+    assert loaded.shape == (2, 3) and loaded[1, 2] == 4.0
@@ -0,0 +1,69 @@
+import importlib.util
+import os
+from pathlib import Path
+
+import numpy as np
+
+# cache.py is a pure module, load it without the package, which imports brightway2.
+_spec = importlib.util.spec_from_file_location(
+    "cache", Path(__file__).parents[1] / "bw_superstructure" / "cache.py"
+)
+cache = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(cache)
+
+
+def result(value: float = 0.0) -> dict:
+    return {"lca_scores": np.full((2, 3), value)}
+
+
+def test_put_get(tmp_path):
+    results = cache.ResultCache(tmp_path / "cache")
+    assert results.get("a") is None
+    results.put("a", result(1.0))
+    assert "a" in results and "b" not in results
+    np.testing.assert_array_equal(results.get("a")["lca_scores"], np.ones((2, 3)))
+    assert results.keys() == ["a"]
+    assert results.size == os.path.getsize(tmp_path / "cache" / "a.pkl")
+
+
+def test_put_replaces(tmp_path):
+    results = cache.ResultCache(tmp_path)
+    results.put("a", result(1.0))
+    results.put("a", {"lca_scores": np.zeros(100)})
+    assert results.get("a")["lca_scores"].shape == (100,)
+    assert results.size == os.path.getsize(tmp_path / "a.pkl")
+
+
+def test_eviction_by_size(tmp_path):
+    size = len(cache.pickle.dumps(result(), protocol=cache.pickle.HIGHEST_PROTOCOL))
+    results = cache.ResultCache(tmp_path, max_size=2 * size)
+    results.put("a", result(1.0))
+    results.put("b", result(2.0))
+    # Reading "a" makes "b" the least recently used result.
+    assert results.get("a") is not None
+    results.put("c", result(3.0))
+    assert "b" not in results
+    assert sorted(results.keys()) == ["a", "c"]
+    assert results.size <= 2 * size
+
+
+def test_reopen(tmp_path):
+    results = cache.ResultCache(tmp_path)
+    results.put("a", result(1.0))
+    results.put("b", result(2.0))
+    os.utime(tmp_path / "a.pkl", (0, 0))
+    reopened = cache.ResultCache(tmp_path)
+    assert reopened.keys() == ["a", "b"]
+    assert reopened.size == results.size
+
+
+def test_invalidate(tmp_path):
+    results = cache.ResultCache(tmp_path)
+    for key in "abc":
+        results.put(key, result())
+    results.invalidate(["a", "missing"])
+    assert sorted(results.keys()) == ["b", "c"]
+    assert "a" not in results and results.get("a") is None
+    results.invalidate()
+    assert results.keys() == [] and results.size == 0
+    assert not list(tmp_path.glob("*.pkl"))
@@ -0,0 +1,198 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+# solvers.py only depends on numpy and scipy, load it without the package, which
+# imports brightway2.
+_spec = importlib.util.spec_from_file_location(
+    "solvers", Path(__file__).parents[1] / "bw_superstructure" / "solvers.py"
+)
+solvers = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(solvers)
+
+SIZE = 40
+
+
+def technosphere_matrix(seed: int = 0) -> sparse.csr_matrix:
+    """Returns a random, diagonally dominant matrix similar to a technosphere matrix
+    (production on the diagonal, small inputs elsewhere)."""
+    inputs = sparse.random(SIZE, SIZE, density=0.1, random_state=seed, format="csr")
+    inputs.setdiag(0)
+    inputs.eliminate_zeros()
+    return (sparse.eye(SIZE) - 0.1 * inputs).tocsr()
+
+
+def right_hand_sides(columns: int = 3) -> np.ndarray:
+    return np.random.default_rng(1).random((SIZE, columns))
+
+
+def assert_solves(solve, matrix, b):
+    dense = matrix.toarray()
+    np.testing.assert_allclose(
+        solve(b), np.linalg.solve(dense, b), rtol=1e-6, atol=1e-10
+    )
+    np.testing.assert_allclose(
+        solve.transposed(b), np.linalg.solve(dense.T, b), rtol=1e-6, atol=1e-10
+    )
+
+
+@pytest.mark.parametrize("name", solvers.available_solvers())
+def test_solver(name):
+    solver = solvers.get_solver(name)
+    matrix = technosphere_matrix()
+    b = right_hand_sides()
+    try:
+        solve = solver.factorize(matrix)
+        assert_solves(solve, matrix, b[:, 0])
+        assert_solves(solve, matrix, b)
+        assert solve.nbytes > 0
+    finally:
+        solver.release()
+
+
+@pytest.mark.parametrize("name", solvers.available_solvers())
+def test_solver_refactorize(name):
+    solver = solvers.get_solver(name)
+    baseline, matrix = technosphere_matrix(), technosphere_matrix()
+    matrix.data *= np.linspace(0.9, 1.1, matrix.nnz)
+    try:
+        solver.factorize(baseline)
+        # Same sparsity pattern, only the numeric factorization is redone.
+        assert_solves(solver.factorize(matrix), matrix, right_hand_sides())
+        # New sparsity pattern, the matrix is analyzed again.
+        other = technosphere_matrix(seed=2)
+        assert_solves(solver.factorize(other), other, right_hand_sides())
+    finally:
+        solver.release()
+
+
+def test_solver_after_release():
+    solver = solvers.get_solver(solvers.default_solver().name)
+    matrix = technosphere_matrix()
+    solver.factorize(matrix)
+    solver.release()
+    assert_solves(solver.factorize(matrix), matrix, right_hand_sides())
+    solver.release()
+
+
+def test_low_rank_update():
+    baseline = technosphere_matrix()
+    columns = np.array([3, 17, 29])
+    delta = np.zeros((SIZE, len(columns)))
+    delta[[0, 5, 11], [0, 1, 2]] = [-0.2, -0.05, -0.3]
+    delta[columns, np.arange(len(columns))] = 0.1
+    change = np.zeros(baseline.shape)
+    change[:, columns] = delta
+    matrix = (baseline + sparse.csr_matrix(change)).tocsr()
+    solve = solvers.low_rank_update(
+        solvers.SuperLUSolver().factorize(baseline), columns, delta
+    )
+    refactorized = solvers.SuperLUSolver().factorize(matrix)
+    b = right_hand_sides()
+    for rhs in (b[:, 0], b):
+        np.testing.assert_allclose(solve(rhs), refactorized(rhs), rtol=1e-10)
+        np.testing.assert_allclose(
+            solve.transposed(rhs), refactorized.transposed(rhs), rtol=1e-10
+        )
+
+
+def test_low_rank_update_without_changes():
+    solve = solvers.SuperLUSolver().factorize(technosphere_matrix())
+    columns, delta = np.array([], dtype=int), np.zeros((SIZE, 0))
+    assert solvers.low_rank_update(solve, columns, delta) is solve
+
+
+def test_reduced_solver():
+    # Block diagonal matrix, the second block is not part of the supply chains.
+    block = technosphere_matrix()
+    matrix = sparse.block_diag([block, technosphere_matrix(seed=3)], format="csr")
+    rows = cols = np.arange(SIZE)
+    solver = solvers.ReducedSolver(solvers.SuperLUSolver(), rows, cols)
+    solve = solver.factorize(matrix)
+    b = np.zeros((2 * SIZE, 3))
+    b[rows] = right_hand_sides()
+    expected = np.linalg.solve(matrix.toarray(), b)
+    np.testing.assert_allclose(solve(b), expected, atol=1e-12)
+    np.testing.assert_allclose(solve(b[:, 0]), expected[:, 0], atol=1e-12)
+    transposed = solve.transposed(b)
+    assert not transposed[SIZE:].any()
+    np.testing.assert_allclose(
+        transposed[rows], np.linalg.solve(block.toarray().T, b[rows]), atol=1e-12
+    )
+
+
+def test_low_rank_update_of_reduced_solver():
+    block = technosphere_matrix()
+    matrix = sparse.block_diag([block, technosphere_matrix(seed=3)], format="csr")
+    rows = cols = np.arange(SIZE)
+    columns = np.array([3, 17])
+    delta = np.zeros((2 * SIZE, len(columns)))
+    delta[[0, 5], [0, 1]] = [-0.2, -0.05]
+    change = np.zeros(matrix.shape)
+    change[:, columns] = delta
+    changed = (matrix + sparse.csr_matrix(change)).tocsr()
+    solve = solvers.low_rank_update(
+        solvers.ReducedSolver(solvers.SuperLUSolver(), rows, cols).factorize(matrix),
+        columns,
+        delta,
+    )
+    refactorized = solvers.ReducedSolver(solvers.SuperLUSolver(), rows, cols)
+    refactorized = refactorized.factorize(changed)
+    b = np.zeros((2 * SIZE, 3))
+    b[rows] = right_hand_sides()
+    np.testing.assert_allclose(solve(b), refactorized(b), atol=1e-12)
+    np.testing.assert_allclose(
+        solve.transposed(b), refactorized.transposed(b), atol=1e-12
+    )
+
+
+def test_iterative_solver_warm_start():
+    solver = solvers.GMRESSolver()
+    baseline, matrix = technosphere_matrix(), technosphere_matrix()
+    matrix.data *= 1.01
+    b = right_hand_sides()
+    solve = solver.factorize(baseline)
+    solve(b)
+    solve.transposed(b)
+    assert_solves(solver.factorize(matrix), matrix, 2 * b)
+    # Only the latest solution per direction and column is kept.
+    assert len(solver._previous) == 2 * b.shape[1]
+
+
+def test_iterative_solver_warm_start_columns():
+    solver = solvers.GMRESSolver()
+    matrix = technosphere_matrix()
+    b = right_hand_sides()
+    solve = solver.factorize(matrix)
+    # Single right-hand sides with their own warm start each.
+    for column in range(b.shape[1]):
+        x = solve(b[:, column], columns=[("demand", column)])
+        np.testing.assert_allclose(x, solver._previous[False, ("demand", column)])
+    assert len(solver._previous) == b.shape[1]
+    np.testing.assert_allclose(
+        solve(b, columns=[("demand", column) for column in range(b.shape[1])]),
+        np.linalg.solve(matrix.toarray(), b),
+        rtol=1e-6,
+    )
+    assert len(solver._previous) == b.shape[1]
+
+
+def test_benchmark_solvers():
+    timings = solvers.benchmark_solvers(technosphere_matrix(), repeat=1)
+    assert set(timings) == set(solvers.available_solvers(iterative=False))
+    assert list(timings.values()) == sorted(timings.values())
+
+
+def test_get_solver():
+    assert isinstance(solvers.get_solver("superlu"), solvers.SuperLUSolver)
+    solver = solvers.GMRESSolver()
+    assert solvers.get_solver(solver) is solver
+    fastest = solvers.get_solver("auto", technosphere_matrix())
+    assert fastest.name in solvers.available_solvers(iterative=False)
+    with pytest.raises(solvers.SolverError, match="Unknown solver"):
+        solvers.get_solver("cholesky")
+    with pytest.raises(solvers.SolverError, match="matrix is needed"):
+        solvers.get_solver("auto")